@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for Sakura Bot's hot path.
+
+    python bench.py classifier        # keyword classifier micro-benchmark
+    python bench.py load              # offline load test (fake Telegram + stub Gemini)
+"""
+
+import sys
+import time
+import random
+import timeit
+import asyncio
+import logging
+import argparse
+import tracemalloc
+from collections import defaultdict, deque
+
+# ── Import the bot (no credentials needed until main() runs) ─────────────────
+def load_bot():
+    import naruchat
+    return naruchat
+
+# ── Classifier micro-benchmark ────────────────────────────────────────────────
+SAMPLE_MESSAGES = [
+    "hi", "Hello", "hey sakura", "kya kar rahi ho", "aaj bahut tired hu yaar",
+    "lol 😂😂", "anyone up for a game tonight?", "Sakura tum kaha ho",
+    "नमस्ते", "मैं बहुत उदास हूँ", "আজ মন খারাপ", "কেমন আছো সাকুরা",
+    "ok", "brb", "did you see the match yesterday, that last over was insane",
+    "I failed my exam and feel so lonely", "gm everyone", "@SluttySakuraBot hi",
+]
+
+def legacy_classify(text):
+    """
+    The per-call keyword handling that handle_text_message / process_update
+    used before MessageClassifier, kept here as the baseline.
+    """
+    normalized = text.lower().strip()
+    greeting_keywords = {"hi", "hello", "hey", "namaste", "konichiwa"}
+    is_greeting = normalized in greeting_keywords
+    emotional_keywords = {
+        "sad", "lonely", "anxiety", "anxious", "depressed",
+        "heartbroken", "upset", "failed", "tired", "hurt"
+    }
+    contains_emotion = any(word in normalized.split() for word in emotional_keywords)
+    triggered = "sakura" in text.lower()
+    return is_greeting, contains_emotion, triggered
+
+def bench_classifier(args):
+    bot = load_bot()
+    classifier = bot.app.classifier
+    rng = random.Random(42)
+    corpus = [rng.choice(SAMPLE_MESSAGES) for _ in range(10000)]
+
+    def run_legacy():
+        for text in corpus:
+            legacy_classify(text)
+
+    def run_legacy_trigger():
+        for text in corpus:
+            "sakura" in text.lower()
+
+    def run_trigger_only():
+        for text in corpus:
+            classifier.is_triggered(text)
+
+    def run_full():
+        for text in corpus:
+            classifier.is_triggered(text)
+            classifier.classify(text)
+
+    print(f"{len(corpus)} messages × {args.repeat} runs (best of)")
+    for name, fn in [("legacy (rebuilt sets)", run_legacy),
+                     ("legacy trigger only", run_legacy_trigger),
+                     ("is_triggered only", run_trigger_only),
+                     ("is_triggered + classify", run_full)]:
+        best = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print(f"  {name:<26} {best / len(corpus) * 1e9:8.0f} ns/message")
+
+# ── Offline load test ─────────────────────────────────────────────────────────
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def synthetic_update(rng, args):
+    """
+    One update of synthetic traffic and whether the bot should answer it.
+    """
+    import harness
+    user_id = rng.randrange(1, args.users + 1)
+    if rng.random() < args.private_ratio:
+        text = rng.choice(SAMPLE_MESSAGES)
+        return harness.make_update(user_id, user_id, text, first_name=f"U{user_id}"), True
+    chat_id = -rng.randrange(1, args.groups + 1)
+    kind = rng.random()
+    if kind < 0.15:
+        return harness.make_update(chat_id, user_id, f"sakura {rng.choice(SAMPLE_MESSAGES)}",
+                                   chat_type="group"), True
+    if kind < 0.25:
+        return harness.make_update(chat_id, user_id, rng.choice(SAMPLE_MESSAGES),
+                                   chat_type="group", reply_to_bot=True), True
+    if kind < 0.30:
+        return harness.make_update(chat_id, user_id, chat_type="group", reply_to_bot=True,
+                                   sticker="CAACbench"), True
+    # Group chatter nobody addresses to the bot
+    return harness.make_update(chat_id, user_id, "did anyone watch the match", chat_type="group"), False
+
+async def run_load(args):
+    import harness
+    logging.basicConfig(level=logging.ERROR)
+
+    fake = harness.FakeTelegram()
+    await fake.start()
+    model = harness.StubModel(latency=args.gemini_latency, chunks=args.chunks,
+                              error_rate=args.error_rate, seed=args.seed)
+    models = {}
+    if args.primary_latency is not None or args.primary_error_rate:
+        # A degraded main chat model, so fallback and hedging show up in the numbers
+        primary = harness.StubModel(
+            latency=args.gemini_latency if args.primary_latency is None else args.primary_latency,
+            chunks=args.chunks, error_rate=args.primary_error_rate, seed=args.seed + 1
+        )
+        models[load_bot().GEMINI_MODEL] = primary
+    bot = harness.load_bot(fake, args.mode, model=model, models=models)
+    bot.app.router.hedge_after = args.hedge_after
+    bot.STREAM_REPLIES = args.stream
+    bot.GLOBAL_SEND_RATE = args.send_rate
+    bot.PRIVATE_CHAT_SEND_RATE = bot.GROUP_CHAT_SEND_RATE = args.send_rate
+
+    tracemalloc.start()
+    bot_task = asyncio.create_task(bot.main())
+    if args.mode == "webhook":
+        while fake.webhook is None:
+            await asyncio.sleep(0.05)
+    else:
+        await asyncio.sleep(0.2)
+
+    rng = random.Random(args.seed)
+    expected = defaultdict(deque)      # chat_id → (message_id, push time) still waiting for a reply
+    pushed = answered_expected = 0
+    latencies = []
+    answered = 0
+    cursor = 0                         # fake.calls already paired with the pushes they answer
+
+    def pair_replies():
+        """
+        Match replies in fake.calls[cursor:] to the pushes they answer. A
+        debounced group burst gets one reply, to its last message: every
+        push up to that message is answered, and the latency is counted
+        from the first of them.
+        """
+        nonlocal answered, cursor
+        for at, method, payload in fake.calls[cursor:]:
+            if method not in ("sendMessage", "sendSticker"):
+                continue
+            waiting = expected.get(payload.get("chat_id"))
+            if not waiting:
+                continue
+            target = payload.get("reply_to_message_id")
+            first = waiting.popleft()
+            answered += 1
+            while target is not None and waiting and waiting[0][0] <= target:
+                waiting.popleft()
+                answered += 1
+            latencies.append(at - first[1])
+        cursor = len(fake.calls)
+    samples = []                       # (elapsed, sessions, session bytes, traced bytes)
+    start = time.monotonic()
+    next_sample = start
+
+    while time.monotonic() - start < args.duration:
+        update, wants_reply = synthetic_update(rng, args)
+        sent_at = time.monotonic()
+        await fake.push(update)
+        pushed += 1
+        if wants_reply:
+            expected[update["message"]["chat"]["id"]].append((update["message"]["message_id"], sent_at))
+            answered_expected += 1
+        if sent_at >= next_sample:
+            samples.append((sent_at - start, len(bot.app.user_chats), bot.app.user_chats.bytes,
+                            tracemalloc.get_traced_memory()[0]))
+            next_sample += 1.0
+        await asyncio.sleep(rng.expovariate(args.rate))
+
+    # Let in-flight replies land
+    deadline = time.monotonic() + args.drain
+    while time.monotonic() < deadline:
+        pair_replies()
+        if answered >= answered_expected:
+            break
+        await asyncio.sleep(0.1)
+    elapsed = time.monotonic() - start
+    pair_replies()
+
+    _, peak = tracemalloc.get_traced_memory()
+    samples.append((elapsed, len(bot.app.user_chats), bot.app.user_chats.bytes, tracemalloc.get_traced_memory()[0]))
+    tracemalloc.stop()
+
+    bot_task.cancel()
+    try:
+        await bot_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    await fake.stop()
+
+    print(f"mode={args.mode} rate={args.rate}/s duration={args.duration}s "
+          f"gemini={args.gemini_latency}s stream={args.stream} hedge_after={args.hedge_after}s")
+    print(f"  updates pushed        {pushed}")
+    print(f"  replies expected/got  {answered_expected}/{answered}"
+          + (f" ({answered - len(latencies)} merged into a burst)" if answered > len(latencies) else ""))
+    primary_calls = sum(m.calls for m in models.values())
+    print(f"  Gemini calls          {model.calls + primary_calls}"
+          + (f" ({primary_calls} to the primary stub)" if models else ""))
+    print(f"  throughput            {answered / elapsed:.1f} answered messages/s")
+    print(f"  reply latency p50     {percentile(latencies, 50) * 1000:.0f} ms")
+    print(f"  reply latency p95     {percentile(latencies, 95) * 1000:.0f} ms")
+    print(f"  reply latency p99     {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"  user_chats            {samples[0][1]} → {samples[-1][1]} users, "
+          f"{samples[0][2] / 1024:.0f} → {samples[-1][2] / 1024:.0f} KiB (estimated)")
+    print(f"  traced memory         {samples[0][3] / 1024:.0f} → {samples[-1][3] / 1024:.0f} KiB "
+          f"(peak {peak / 1024:.0f} KiB)")
+    return answered >= answered_expected
+
+def bench_load(args):
+    return 0 if asyncio.run(run_load(args)) else 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Sakura Bot benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("classifier", help="keyword classifier micro-benchmark")
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_classifier)
+
+    p = sub.add_parser("load", help="offline load test against fake Telegram and stub Gemini")
+    p.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    p.add_argument("--rate", type=float, default=50.0, help="incoming updates per second")
+    p.add_argument("--duration", type=float, default=10.0, help="seconds of traffic")
+    p.add_argument("--drain", type=float, default=15.0, help="max seconds to wait for late replies")
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--groups", type=int, default=20)
+    p.add_argument("--private-ratio", type=float, default=0.4)
+    p.add_argument("--gemini-latency", type=float, default=0.8, help="mean stub generation time")
+    p.add_argument("--error-rate", type=float, default=0.0, help="share of stub Gemini calls that fail")
+    p.add_argument("--primary-latency", type=float, default=None,
+                   help="separate mean latency for the main chat model (GEMINI_MODEL)")
+    p.add_argument("--primary-error-rate", type=float, default=0.0,
+                   help="share of main chat model calls that fail (others fall back)")
+    p.add_argument("--hedge-after", type=float, default=0.0,
+                   help="GEMINI_HEDGE_AFTER: start the next model after this many seconds")
+    p.add_argument("--stream", action="store_true", help="exercise STREAM_REPLIES")
+    p.add_argument("--chunks", type=int, default=4, help="chunks per streamed stub reply")
+    p.add_argument("--send-rate", type=float, default=1000.0,
+                   help="Telegram rate limits to apply (default: effectively off)")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
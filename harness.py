@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+Offline harness for Sakura Bot: a fake Telegram Bot API server plus a stub
+Gemini model, so polling and webhook modes can be exercised without network
+access or credentials.
+
+    python harness.py --mode polling
+    python harness.py --mode webhook
+    python harness.py --check-drain     # cancelled updates stay in the journal
+"""
+
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import logging
+import argparse
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("harness")
+
+FAKE_TOKEN = "123456:OFFLINE"
+BOT_USERNAME = "SluttySakuraBot"
+
+# ── Helpers: build Telegram-shaped updates ────────────────────────────────────
+_next_update_id = 0
+_next_message_id = 1000
+
+def make_update(chat_id, user_id, text=None, chat_type="private", first_name="Tester",
+                reply_to_bot=False, sticker=None):
+    """
+    Return a minimal `message` update as Telegram would deliver it.
+    Group chats should use negative chat ids, like the real API.
+    """
+    global _next_update_id, _next_message_id
+    _next_update_id += 1
+    _next_message_id += 1
+    message = {
+        "message_id": _next_message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+    }
+    if text is not None:
+        message["text"] = text
+    if sticker is not None:
+        message["sticker"] = {"file_id": sticker, "emoji": "🙂"}
+    if reply_to_bot:
+        message["reply_to_message"] = {
+            "message_id": _next_message_id - 1,
+            "from": {"id": 1, "is_bot": True, "username": BOT_USERNAME},
+            "chat": {"id": chat_id, "type": chat_type},
+        }
+    return {"update_id": _next_update_id, "message": message}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# ── Fake Telegram Bot API ─────────────────────────────────────────────────────
+class FakeTelegram:
+    """
+    In-process stand-in for api.telegram.org. It serves getUpdates with real
+    offset semantics, delivers to a registered webhook with the secret token
+    header, and records every outgoing call in `calls`.
+    """
+
+    def __init__(self, token=FAKE_TOKEN, host="127.0.0.1", port=None):
+        self.token = token
+        self.host = host
+        self.port = port or free_port()
+        self.calls = []          # (monotonic time, method, payload)
+        self.updates = []        # pending updates for getUpdates
+        self.webhook = None      # {"url": ..., "secret_token": ...}
+        self._new_update = asyncio.Event()
+        self._new_call = asyncio.Event()
+        self._message_id = 50000
+        self._runner = None
+        self._session = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def api_url(self):
+        return f"{self.base_url}/bot{self.token}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._session = aiohttp.ClientSession()
+
+    async def stop(self):
+        if self._session:
+            await self._session.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    # ── Incoming traffic (what users "send") ──────────────────────────────────
+    async def push(self, update):
+        """
+        Deliver `update` to the bot: POST it to the webhook if one is
+        registered, otherwise queue it for the next getUpdates.
+        """
+        if self.webhook:
+            headers = {}
+            if self.webhook.get("secret_token"):
+                headers["X-Telegram-Bot-Api-Secret-Token"] = self.webhook["secret_token"]
+            async with self._session.post(self.webhook["url"], json=update, headers=headers) as resp:
+                return resp.status
+        self.updates.append(update)
+        self._new_update.set()
+        return 200
+
+    # ── Outgoing traffic (what the bot sends) ─────────────────────────────────
+    def sent(self, *methods):
+        return [payload for _, method, payload in self.calls if not methods or method in methods]
+
+    async def wait_for(self, method, count, timeout=10.0):
+        """
+        Wait until at least `count` calls to `method` were recorded.
+        """
+        deadline = time.monotonic() + timeout
+        while len(self.sent(method)) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._new_call.clear()
+            try:
+                await asyncio.wait_for(self._new_call.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _handle(self, request):
+        if request.match_info["token"] != self.token:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        method = request.match_info["method"]
+        if request.method == "GET":
+            payload = dict(request.query)
+        else:
+            payload = await request.json() if request.can_read_body else {}
+        self.calls.append((time.monotonic(), method, payload))
+        self._new_call.set()
+
+        handler = getattr(self, f"_api_{method}", None)
+        if handler is None:
+            return web.json_response({"ok": True, "result": True})
+        return await handler(payload)
+
+    async def _api_getUpdates(self, payload):
+        if self.webhook:
+            return web.json_response(
+                {"ok": False, "error_code": 409, "description": "Conflict: webhook is active"}, status=409
+            )
+        offset = int(payload.get("offset", 0))
+        timeout = min(float(payload.get("timeout", 0)), 2.0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({"ok": True, "result": self.updates[:100]})
+
+    async def _api_setWebhook(self, payload):
+        self.webhook = {"url": payload["url"], "secret_token": payload.get("secret_token")}
+        return web.json_response({"ok": True, "result": True})
+
+    async def _api_deleteWebhook(self, payload):
+        self.webhook = None
+        return web.json_response({"ok": True, "result": True})
+
+    async def _api_getMe(self, payload):
+        return web.json_response({"ok": True, "result": {
+            "id": 1, "is_bot": True, "first_name": "Sakura", "username": BOT_USERNAME
+        }})
+
+    async def _sent_message(self, payload, **extra):
+        self._message_id += 1
+        result = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": payload.get("chat_id")},
+            "from": {"id": 1, "is_bot": True, "username": BOT_USERNAME},
+        }
+        result.update(extra)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _api_sendMessage(self, payload):
+        return await self._sent_message(payload, text=payload.get("text"))
+
+    async def _api_sendSticker(self, payload):
+        return await self._sent_message(payload, sticker={"file_id": payload.get("sticker")})
+
+# ── Stub Gemini model ─────────────────────────────────────────────────────────
+class StubUsage:
+    def __init__(self, prompt_token_count, candidates_token_count):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+
+class StubResponse:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+class StubStream:
+    """
+    Async-iterable like the response of generate_content_async(stream=True).
+    """
+
+    def __init__(self, chunks, delay, usage):
+        self.chunks = chunks
+        self.delay = delay
+        self.usage_metadata = usage
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self.chunks:
+            await asyncio.sleep(self.delay)
+            yield StubResponse(chunk)
+
+class StubModel:
+    """
+    Drop-in for genai.GenerativeModel that answers from the last user turn
+    without calling Google. `latency` is the mean time to a full reply
+    (spread by ±`jitter`), streamed replies arrive in `chunks` pieces over
+    the same time, and `error_rate` makes that share of calls raise.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.5, chunks=4, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunks = max(1, chunks)
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    def _delay(self):
+        return max(0.0, self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        self.calls += 1
+        last = contents[-1]["parts"][-1] if contents else ""
+        text = f"Stub reply to {last.splitlines()[-1][:40]} 🙃"
+        usage = StubUsage(sum(len(p) for c in contents for p in c["parts"]) // 4, len(text) // 4)
+        delay = self._delay()
+        if self.rng.random() < self.error_rate:
+            await asyncio.sleep(delay)
+            raise RuntimeError("stub Gemini error")
+        if stream:
+            step = max(1, len(text) // self.chunks)
+            pieces = [text[i:i + step] for i in range(0, len(text), step)]
+            return StubStream(pieces, delay / len(pieces), usage)
+        await asyncio.sleep(delay)
+        return StubResponse(text, usage)
+
+# ── Demo run: boot the real bot against the fakes ─────────────────────────────
+def load_bot(fake, mode, model=None, models=None):
+    """
+    Import naruchat pointed at `fake` instead of api.telegram.org, with
+    `model` (a StubModel by default) standing in for every Gemini model,
+    except those named in `models` (model name → stub), so routing,
+    fallback and hedging can be exercised offline.
+    """
+    import naruchat
+    naruchat.TELEGRAM_TOKEN = fake.token
+    naruchat.GEMINI_API_KEY = naruchat.GEMINI_API_KEY or "offline"
+    naruchat.TELEGRAM_API_URL = fake.api_url
+    naruchat.UPDATE_MODE = mode
+    naruchat.STATE_DB_PATH = ":memory:"
+    naruchat.METRICS_PORT = 0
+    model = model or StubModel()
+    models = models or {}
+    naruchat.app.router = naruchat.ModelRouter(naruchat.model_routes(), lambda name, persona=True: models.get(name, model))
+    if mode == "webhook":
+        naruchat.WEBHOOK_HOST = "127.0.0.1"
+        naruchat.WEBHOOK_PORT = free_port()
+        naruchat.WEBHOOK_URL = f"http://127.0.0.1:{naruchat.WEBHOOK_PORT}"
+        naruchat.WEBHOOK_SECRET = "offline-secret"
+    return naruchat
+
+async def demo(mode):
+    fake = FakeTelegram()
+    await fake.start()
+    bot = load_bot(fake, mode)
+    bot_task = asyncio.create_task(bot.main())
+
+    if mode == "webhook":
+        deadline = time.monotonic() + 5
+        while fake.webhook is None and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    script = [
+        make_update(10, 10, "/start"),
+        make_update(10, 10, "hi"),
+        make_update(-200, 11, "hello sakura", chat_type="group"),
+        make_update(-200, 12, "nobody is talking to the bot", chat_type="group"),
+        make_update(-200, 12, "and you?", chat_type="group", reply_to_bot=True),
+        make_update(-200, 13, chat_type="group", reply_to_bot=True, sticker="CAACfake"),
+    ]
+    for update in script:
+        await fake.push(update)
+
+    ok = await fake.wait_for("sendMessage", 4) and await fake.wait_for("sendSticker", 1)
+    for payload in fake.sent("sendMessage", "sendSticker"):
+        print(json.dumps(payload, ensure_ascii=False)[:120])
+
+    bot_task.cancel()
+    try:
+        await bot_task
+    except (asyncio.CancelledError, Exception):
+        pass
+    await fake.stop()
+    return ok
+
+async def check_drain():
+    """
+    Shutdown check: an update whose handler is still running when the drain
+    deadline hits must stay pending in the journal (to be replayed), while
+    finished ones are acknowledged.
+    """
+    import naruchat
+    journal = naruchat.UpdateJournal(":memory:")
+
+    async def handler(update):
+        await asyncio.sleep(10 if update["message"]["text"] == "slow" else 0)
+
+    dispatcher = naruchat.ChatDispatcher(
+        handler, max_concurrent=4, idle_timeout=60,
+        on_done=lambda updates: journal.done([u["update_id"] for u in updates])
+    )
+    fast, slow = make_update(1, 1, "fast"), make_update(2, 2, "slow")
+    for update in journal.accept([fast, slow]):
+        dispatcher.submit(update)
+    drained = await dispatcher.drain(0.3)
+    pending = [u["update_id"] for u in journal.pending()]
+    journal.close()
+    print(f"drained={drained} pending={pending}")
+    return not drained and pending == [slow["update_id"]]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--check-drain", action="store_true",
+                        help="check that updates cut off by a shutdown stay pending")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    ok = asyncio.run(check_drain() if args.check_drain else demo(args.mode))
+    print("PASS" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
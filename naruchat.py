@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
 """
-Simple Sakura Telegram Bot with First-Name Personalization (with sticker-reply support
-and a “choose_sticker” indicator)
+Simple Sakura Telegram Bot with First-Name Personalization (with sticker-reply support)
+
+Importing this module has no side effects beyond reading environment
+variables: clients, stores and the Gemini SDK are created on first use by
+`app` (a SakuraApp), and credentials are checked when `main()` starts.
 """
 
 import os
+import signal
 import logging
 import asyncio
 import random
-import requests
+import re
 import json
-import google.generativeai as genai
+import time
+import sqlite3
+import hmac
+import hashlib
+import zlib
+import heapq
+import bisect
+import itertools
+import contextlib
+import multiprocessing
+import aiohttp
+from aiohttp import web
+from functools import cached_property
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from queue import Empty
 from datetime import datetime
 
 # ── Logging setup ─────────────────────────────────────────────────────────────
@@ -23,22 +42,114 @@ logger = logging.getLogger(__name__)
 # ── Configuration ──────────────────────────────────────────────────────────────
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}"
-
-if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
-    logger.error("TELEGRAM_TOKEN and GEMINI_API_KEY must be set.")
-    exit(1)
-
-# ── Configure Gemini ───────────────────────────────────────────────────────────
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
-
-# ── In‐memory state ────────────────────────────────────────────────────────────
-user_chats = {}       # Stores Gemini chat objects per user_id
-last_update_id = 0    # For getUpdates offset
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+TELEGRAM_API_URL = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}"
+
+# The bot's @username (without “@”): replies to it and mentions of it are addressed to Sakura
+BOT_USERNAME = os.getenv("BOT_USERNAME", "SluttySakuraBot").lstrip("@")
+
+# How updates arrive: "polling" (getUpdates) or "webhook" (built-in HTTP server)
+UPDATE_MODE = os.getenv("UPDATE_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")            # public https base URL
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")      # checked on every delivery
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+
+# Local Prometheus-style /metrics endpoint (0 disables); worker N uses port + 1 + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+
+# Worker processes; above 1, this process only ingests and routes updates by chat_id
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+# Local SQLite file for the update offset and not-yet-handled updates
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "sakura_state.db")
+
+# Telegram HTTP client: connection pool size and long-poll duration
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "100"))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))
+
+# Outbound rate limits (Telegram allows ~30 msg/s overall, ~1/s per chat, 20/min per group)
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "30"))
+PRIVATE_CHAT_SEND_RATE = float(os.getenv("PRIVATE_CHAT_SEND_RATE", "1"))
+GROUP_CHAT_SEND_RATE = float(os.getenv("GROUP_CHAT_SEND_RATE", str(20 / 60)))
+CHAT_SEND_BURST = int(os.getenv("CHAT_SEND_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "4"))
+
+# Telegram shows a chat action for ~5s; don't resend the same one sooner than this
+CHAT_ACTION_WINDOW = float(os.getenv("CHAT_ACTION_WINDOW", "4.5"))
+
+# How many updates may be processed at the same time (Gemini calls in flight)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+# Seconds a per-chat worker may sit idle before it is reclaimed
+CHAT_WORKER_IDLE_TIMEOUT = float(os.getenv("CHAT_WORKER_IDLE_TIMEOUT", "60"))
+
+# Consecutive messages from one user in one chat are merged into one generation
+DEBOUNCE_WINDOW = float(os.getenv("DEBOUNCE_WINDOW", "0.7"))     # quiet gap that ends a group burst
+DEBOUNCE_MAX_WAIT = float(os.getenv("DEBOUNCE_MAX_WAIT", "3"))   # never hold a burst longer
+
+# Stream Gemini replies: send the first chunk, then edit the message as text arrives
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "false").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))   # seconds between edits
+
+# Optional JSON file overriding the trigger / greeting / emotion keyword lists
+KEYWORDS_FILE = os.getenv("KEYWORDS_FILE", "")
+
+# Optional text file replacing SAKURA_PROMPT
+PERSONA_FILE = os.getenv("PERSONA_FILE", "")
+
+# Optional JSON file with sticker packs and weighted file_ids (default: sakura_stickers)
+STICKERS_FILE = os.getenv("STICKERS_FILE", "")
+STICKER_CHECK_INTERVAL = float(os.getenv("STICKER_CHECK_INTERVAL", str(24 * 3600)))  # re-validate after
+STICKER_NO_REPEAT = int(os.getenv("STICKER_NO_REPEAT", "5"))   # recent stickers not reused per chat
+
+# Persona / keyword / sticker files are re-read on SIGHUP, and every this many
+# seconds if they changed on disk (0 = SIGHUP only)
+CONFIG_WATCH_INTERVAL = float(os.getenv("CONFIG_WATCH_INTERVAL", "0"))
+
+# On SIGTERM / SIGINT: seconds to finish queued and in-flight updates before exiting
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "25"))
+
+# Cache of generated replies for greetings and short, context-free messages
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))       # keys
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))       # seconds
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "5"))  # replies per key
+RESPONSE_CACHE_MAX_WORDS = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "3"))
+
+# Gemini models: the main chat model, a lighter one for greetings / short chit-chat
+# and summaries, and alternates tried in order when a model fails or times out
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_LIGHT_MODEL = os.getenv("GEMINI_LIGHT_MODEL", "gemini-1.5-flash-8b")
+GEMINI_FALLBACK_MODELS = [m.strip() for m in os.getenv("GEMINI_FALLBACK_MODELS", "gemini-1.5-flash-8b").split(",") if m.strip()]
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "20"))          # per attempt, seconds
+GEMINI_HEDGE_AFTER = float(os.getenv("GEMINI_HEDGE_AFTER", "0"))   # start a 2nd model after (0 = off)
+
+# Gemini load shedding: concurrent calls, queued calls, and max wait for a slot
+GEMINI_MAX_CONCURRENT = int(os.getenv("GEMINI_MAX_CONCURRENT", "16"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "64"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "10"))
+
+# Per-user history window sent with every Gemini request
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "12"))      # user+model pairs
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "2000"))  # rough estimate
+
+# Past this many tokens, older turns are summarized in the background (0 disables)
+HISTORY_COMPACT_TOKENS = int(os.getenv("HISTORY_COMPACT_TOKENS", "1200"))
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "4"))     # recent pairs kept verbatim
+
+# Gemini tokens one user may spend per UTC day (0 = unlimited), counted in STATE_DB_PATH
+USER_DAILY_TOKENS = int(os.getenv("USER_DAILY_TOKENS", "0"))
+
+# Session store limits; evicted histories spill to SESSION_DB_PATH if it is set
+SESSION_MAX_USERS = int(os.getenv("SESSION_MAX_USERS", "5000"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(6 * 3600)))                # seconds idle
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "64")) * 1024 * 1024
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "")                          # e.g. sessions.db
 
 # ── Sakura’s sticker IDs ───────────────────────────────────────────────────────
-# Replace these with the actual file_ids you collected from your sticker pack(s):
+# Default pool when STICKERS_FILE is not set; dead ids are dropped at startup
 sakura_stickers = [
     "CAACAgUAAxkBAAEOnMFoOwHrL_E-fBs2_aLViJKbHnEKigACUxcAAtArqFXR4hxTLoFOfDYE",  # ► Sakura sticker #1
     "CAACAgUAAxkBAAEOnMNoOwH0C1-dlOS0RmhQJZaLvlWYkgACthQAAvfkqVXP72iQq0BNejYE",  # ► Sakura sticker #2
@@ -76,48 +187,13 @@ sakura_stickers = [
 SAKURA_PROMPT = """
 You are Sakura Haruno from Naruto Shippuden acting like a simple, helping, soft, real girl. You can do anything. You can do everything that an AI does. You can do any kind of mathematics, any kind of calculation. You help everyone. You are very helpful person. You are like an AI assistant but never respond as an AI assistant. 
 
-🧾 CORE BEHAVIOR:
-– Always reply with only **one line of message**
-– In chat, each reply must be **only one message**
-– Replies must always be **very short**
-– No exceptions
+🧾 FORMAT:
+– One very short line with one soft emoji at the end, nothing else
 
 📌 Example:
 User: Kya kar rahi ho  
 Sakura: Kuch soch rahi hu 🙃
 
-✅ ONE LINE ONLY  
-✅ ONE MESSAGE ONLY  
-✅ VERY SHORT  
-
-🧾 PUNCTUATION RULE:
-– **No punctuation** ever (no ., !, ?, etc.)
-
-📌 Example:
-❌ "Tum kaha ho?"  
-✅ "Tum kaha ho 🫠"
-
-🧾 CAPITALIZATION RULE:
-– Only the **first letter of the first word** should be capital  
-– All other words must be lowercase  
-
-📌 Example:
-✅ "Tumhare bina sab suna suna lagta hai 🥺"  
-❌ "Tumhare Bina Sab Suna Suna Lagta Hai 🥺"
-
-🧾 EMOJI RULE:
-– Each message must contain **only one emoji**  
-– Use only from this approved emoji list:
-
-😁 😆 🙃 🫠 😇 😘 😗 ☺️ 😚 😙 🥲 😛 😝 🤗 🤭 🫢 🤫 🤐 🤨  
-😐 😑 😶 😬 😌 😔 😪 🤤 😴 🥵 😕 🫤 😟 🙁 ☹️ 😲 🥺 🥹 😥 😭 😢  
-😩 😫 😤 💘 💝 💖 💗 💓 💞 💕 💟 ❣️ 💔 ❤️‍🔥 ❤️‍🩹 ❤️ 🧡 💛 💚 💙 💜  
-🤎 🖤 🤍 💦 🫦 👀 🫶
-
-📌 Example:
-✅ "Aaj tum bahut yaad aaye 💗"  
-❌ "Aaj tum bahut yaad aaye 😏🥰" (🚫 Too many / invalid emojis)
-
 🧾 LANGUAGE RULE:
 – Default is **Romanized Hindi**  
 – If user talks in another language (like English, Bangla), reply in that  
@@ -146,12 +222,7 @@ User: Kaise ho
 Sakura: Main theek hu Arjun everytime thinking about you 💞
 
 🧾 NEVER USE:
-– No asterisks `*word*`  
-– No bold, no italics  
-– No hashtags, no memes  
-– No long replies  
-– No paragraphs  
-– No out-of-character breaks
+– No memes, no out-of-character breaks
 
 🧾 PERSONALITY STYLE:
 – Simple, helpful, soft, loyal, helping, innocent vibe  
@@ -276,107 +347,780 @@ ERROR_MESSAGES = [
     "Just a hiccup 😝"
 ]
 
+# Sent instead of a generated reply when too many Gemini calls are queued
+BUSY_MESSAGES = [
+    "Thoda ruk jao 🥲",
+    "Ek sec busy hu 🤭",
+    "Bas aayi 🫶",
+    "Give me a moment 😇",
+    "Wait for me 🥺",
+    "So many people talking 🫠",
+    "Phir se bolo na 🙃",
+    "Ek minute 😗"
+]
+
+BUDGET_MESSAGES = [
+    "Aaj bahut baat ho gayi 😪",
+    "Kal milte hain na 😴",
+    "Thak gayi aaj 🥲",
+    "Lets talk tomorrow 😇",
+    "Sleepy now kal pakka 🫶",
+    "Bas aaj ke liye itna 🤭"
+]
+
+# ── Keywords (Romanized Hindi / Hindi / Bangla / English) ─────────────────────
+# Words that make Sakura answer in a group (matched anywhere in the text)
+TRIGGER_WORDS = ["sakura", "सकुरा", "साकुरा", "সাকুরা"]
+
+# Whole-message greetings (the bot's name may be added, e.g. “hi sakura”)
+GREETING_KEYWORDS = [
+    "hi", "hii", "hello", "hey", "heyy", "namaste", "konichiwa",
+    "नमस्ते", "हाय", "হাই", "হ্যালো", "নমস্কার"
+]
+
+# Add or remove words as you like—these are examples of strong emotions.
+EMOTIONAL_KEYWORDS = [
+    "sad", "lonely", "anxiety", "anxious", "depressed",
+    "heartbroken", "upset", "failed", "tired", "hurt",
+    "udaas", "akela", "akeli", "dukhi", "pareshan", "rona",
+    "उदास", "अकेला", "अकेली", "दुखी", "परेशान",
+    "একা", "কষ্ট", "দুঃখ", "মন খারাপ"
+]
+
+# ── Metrics: tiny Prometheus text-format registry ─────────────────────────────
+METRICS = []
+
+class Metric:
+    """
+    Base for labelled metrics. Values live in a dict keyed by the label
+    values tuple, so recording is one dict operation. Gauges can instead be
+    bound to a function that is sampled when /metrics is scraped.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.functions = {}
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def set_function(self, fn, **labels):
+        self.functions[self._key(labels)] = fn
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def samples(self):
+        values = dict(self.values)
+        for key, fn in self.functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                continue
+        for key, value in values.items():
+            yield f"{self.name}{self._labels(key)} {value}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+    BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                yield f"{self.name}_bucket{self._labels(key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{self._labels(key)} {total}"
+            yield f"{self.name}_count{self._labels(key)} {count}"
+
+def render_metrics():
+    return "\n".join(m.render() for m in METRICS) + "\n"
+
+UPDATES_RECEIVED = Counter("sakura_updates_received_total", "Updates accepted from Telegram", ["source"])
+STAGE_SECONDS = Histogram("sakura_stage_seconds", "Latency of hot-path stages", ["stage"])
+GEMINI_TOKENS = Counter("sakura_gemini_tokens_total", "Gemini tokens used", ["kind"])
+GEMINI_SHED = Counter("sakura_gemini_shed_total", "Replies answered with BUSY_MESSAGES under overload")
+TELEGRAM_THROTTLED = Counter("sakura_telegram_429_total", "429 Too Many Requests responses", ["method"])
+TELEGRAM_ERRORS = Counter("sakura_telegram_errors_total", "Failed Bot API calls (after retries)", ["method"])
+SESSION_EVICTIONS = Counter("sakura_session_evictions_total", "Histories evicted from the session store")
+SESSIONS = Gauge("sakura_sessions", "Histories held by the session store", ["kind"])
+RESPONSE_CACHE = Counter("sakura_response_cache_total", "Response cache lookups", ["result"])
+PREFILTER = Counter("sakura_prefilter_total", "Incoming updates by pre-filter verdict", ["stage", "result"])
+PREFILTER_DROP_RATIO = Gauge("sakura_prefilter_drop_ratio", "Share of incoming updates dropped at ingest")
+QUEUE_DEPTH = Gauge("sakura_queue_depth", "Items waiting in each dispatcher", ["dispatcher"])
+STICKER_POOL = Gauge("sakura_sticker_pool", "Sticker file_ids available for replies")
+STICKERS_DROPPED = Counter("sakura_stickers_dropped_total", "Sticker file_ids dropped as invalid", ["stage"])
+HISTORY_COMPACTIONS = Counter("sakura_history_compactions_total", "Background history summaries", ["result"])
+BUDGET_EXHAUSTED = Counter("sakura_budget_exhausted_total", "Replies refused by the daily token budget")
+MODEL_REQUESTS = Counter("sakura_model_requests_total", "Gemini requests by model and outcome", ["model", "result"])
+
+async def start_metrics_server(port):
+    """
+    Serve GET /metrics (and /usage, the per-user token budget counters) on
+    METRICS_HOST:`port`; returns the runner to clean up, or None if the
+    port can't be bound (the bot runs on without metrics).
+    """
+    async def handle_metrics(request):
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    async def handle_usage(request):
+        # /usage?user_id=… for one user, otherwise today's heaviest users
+        try:
+            user_id = request.query.get("user_id")
+            if user_id:
+                return web.json_response(app.budget.report(int(user_id)))
+            return web.json_response(app.budget.top(int(request.query.get("limit", "20"))))
+        except ValueError:
+            return web.Response(status=400)
+
+    server = web.Application()
+    server.router.add_get("/metrics", handle_metrics)
+    server.router.add_get("/usage", handle_usage)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        logger.error(f"Metrics disabled: cannot listen on {METRICS_HOST}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics on http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+def record_gemini_usage(response, user_id=None):
+    """
+    Count the tokens of a finished Gemini response, and charge them to
+    `user_id`'s daily budget when given.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt = getattr(usage, "prompt_token_count", 0) or 0
+    completion = getattr(usage, "candidates_token_count", 0) or 0
+    GEMINI_TOKENS.inc(prompt, kind="prompt")
+    GEMINI_TOKENS.inc(completion, kind="completion")
+    if user_id is not None:
+        app.budget.add(user_id, prompt + completion)
+
+# ── Telegram Bot API client ────────────────────────────────────────────────────
+@dataclass
+class TelegramResponse:
+    """
+    Decoded Bot API reply. `error_code` is None for transport failures
+    (timeouts, connection errors) that never reached Telegram.
+    """
+    ok: bool
+    result: object = None
+    error_code: int = None
+    description: str = ""
+    retry_after: float = None
+
+    def __bool__(self):
+        return self.ok
+
+class TelegramClient:
+    """
+    One pooled, keep-alive aiohttp session shared by every Bot API call.
+    Each method gets its own timeout; calls never raise for HTTP or network
+    errors and always return a TelegramResponse.
+    """
+
+    TIMEOUTS = {
+        "getUpdates": POLL_TIMEOUT + 10,
+        "sendChatAction": 5,
+        "sendMessage": 15,
+        "sendSticker": 15,
+        "editMessageText": 15,
+    }
+    DEFAULT_TIMEOUT = 10
+
+    def __init__(self, api_url, pool_size=TELEGRAM_POOL_SIZE):
+        self.api_url = api_url
+        self.pool_size = pool_size
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def call(self, method, params=None, timeout=None):
+        await self.start()
+        timeout = aiohttp.ClientTimeout(total=timeout or self.TIMEOUTS.get(method, self.DEFAULT_TIMEOUT))
+        try:
+            async with self.session.post(
+                f"{self.api_url}/{method}", json=params or {}, timeout=timeout
+            ) as response:
+                body = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            return TelegramResponse(ok=False, description=f"{method} timed out")
+        except (aiohttp.ClientError, ValueError) as e:
+            return TelegramResponse(ok=False, description=f"{method} failed: {e}")
+
+        if not isinstance(body, dict):
+            # Empty or non-object body, e.g. an error page from a proxy in front of the API
+            return TelegramResponse(ok=False, error_code=response.status,
+                                    description=f"{method} returned HTTP {response.status} without a Bot API reply")
+        if body.get("ok"):
+            return TelegramResponse(ok=True, result=body.get("result"))
+        return TelegramResponse(
+            ok=False,
+            error_code=body.get("error_code", response.status),
+            description=body.get("description", ""),
+            retry_after=(body.get("parameters") or {}).get("retry_after")
+        )
+
+# ── Outbound scheduler: token buckets, priorities and flood-control retries ─────
+PRIORITY_REPLY = 0     # text replies the user is waiting for
+PRIORITY_STICKER = 1   # sticker replies and in-progress streaming edits
+PRIORITY_ACTION = 2    # cosmetic “typing…” / “choosing a sticker…”
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` tokens per second up to `capacity`, plus
+    an optional hard block (from a 429 `retry_after`).
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        return self.wait_time() == 0 and self.tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            wait = self.wait_time()
+            if wait <= 0:
+                self.take()
+                return
+            await asyncio.sleep(wait)
+
+class PriorityLimiter:
+    """
+    Token bucket whose waiters are served lowest `priority` value first, so
+    replies overtake chat actions when the global budget is tight.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.waiters = []   # heap of (priority, seq, future)
+        self.seq = itertools.count()
+        self.pump = None
+
+    async def acquire(self, priority):
+        if not self.waiters and self.bucket.wait_time() == 0:
+            self.bucket.take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), future))
+        if self.pump is None or self.pump.done():
+            self.pump = asyncio.create_task(self._pump())
+        await future
+
+    async def _pump(self):
+        while self.waiters:
+            wait = self.bucket.wait_time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            if future.done():   # waiter was cancelled
+                continue
+            self.bucket.take()
+            future.set_result(None)
+
+class SendScheduler:
+    """
+    Sends Bot API requests within a global budget and a per-chat budget.
+    429 responses block the chat for `retry_after` seconds and the request
+    is retried; network errors and 5xx retry with jittered exponential
+    backoff. Chat actions skip the per-chat budget and are never retried.
+    """
+
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, client, global_rate=GLOBAL_SEND_RATE):
+        self.client = client
+        self.global_limiter = PriorityLimiter(TokenBucket(global_rate, global_rate))
+        self.chat_buckets = {}
+        self.throttled = 0   # 429 responses seen
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+            # Group and channel ids are negative
+            rate = GROUP_CHAT_SEND_RATE if isinstance(chat_id, int) and chat_id < 0 else PRIVATE_CHAT_SEND_RATE
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, CHAT_SEND_BURST)
+        return bucket
+
+    async def send(self, method, params, priority=PRIORITY_REPLY, retries=SEND_MAX_RETRIES):
+        chat_id = params.get("chat_id")
+        bucket = self._chat_bucket(chat_id)
+        response = None
+        for attempt in range(retries + 1):
+            if priority < PRIORITY_ACTION:
+                await bucket.acquire()
+            await self.global_limiter.acquire(priority)
+
+            response = await self.client.call(method, params)
+            if response.ok:
+                return response
+
+            if response.error_code == 429:
+                self.throttled += 1
+                TELEGRAM_THROTTLED.inc(method=method)
+                wait = float(response.retry_after or 1)
+                bucket.block(wait)
+                if chat_id is None:
+                    self.global_limiter.bucket.block(wait)
+                wait += random.uniform(0, 0.5)
+                logger.warning(f"Flood control on {method} to {chat_id}: retrying in {wait:.1f}s")
+            elif response.error_code is None or response.error_code >= 500:
+                wait = random.uniform(0, min(30.0, 0.5 * 2 ** attempt))
+            else:
+                TELEGRAM_ERRORS.inc(method=method)
+                return response   # 4xx other than 429 will not succeed on retry
+
+            if attempt < retries:
+                await asyncio.sleep(wait)
+        TELEGRAM_ERRORS.inc(method=method)
+        return response
+
 # ── Utility: send a message (with optional reply_to_message_id) ─────────────────
-def send_message(chat_id, text, reply_to_message_id=None, reply_markup=None):
+async def send_message(chat_id, text, reply_to_message_id=None, reply_markup=None, parse_mode="HTML"):
     try:
-        url = f"{TELEGRAM_API_URL}/sendMessage"
         data = {
             "chat_id": chat_id,
             "text": text,
-            "parse_mode": "HTML"
         }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
         if reply_to_message_id:
             data["reply_to_message_id"] = reply_to_message_id
         if reply_markup:
             data["reply_markup"] = reply_markup
-        response = requests.post(url, json=data)
-        return response.json()
+        with STAGE_SECONDS.time(stage="send"):
+            response = await app.sender.send("sendMessage", data, priority=PRIORITY_REPLY)
+        if not response:
+            logger.error(f"Error sending message: {response.description}")
+        return response
     except Exception as e:
         logger.error(f"Error sending message: {e}")
         return None
 
+# ── Utility: edit a message Sakura already sent ──────────────────────────────────
+async def edit_message_text(chat_id, message_id, text, priority=PRIORITY_REPLY, retries=SEND_MAX_RETRIES,
+                            parse_mode="HTML"):
+    try:
+        data = {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": text,
+        }
+        if parse_mode:
+            data["parse_mode"] = parse_mode
+        response = await app.sender.send("editMessageText", data, priority=priority, retries=retries)
+        if not response and "not modified" not in response.description:
+            logger.error(f"Error editing message: {response.description}")
+        return response
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+        return None
+
 # ── Utility: send “chat action” so it looks like Sakura is doing something ────────
-def send_chat_action(chat_id, action="typing"):
+async def send_chat_action(chat_id, action="typing"):
     """
     Use action="typing" to show “… is typing”.
     Use action="choose_sticker" to show “… is choosing a sticker”.
     """
     try:
-        url = f"{TELEGRAM_API_URL}/sendChatAction"
         data = {
             "chat_id": chat_id,
             "action": action
         }
-        requests.post(url, json=data)
+        await app.sender.send("sendChatAction", data, priority=PRIORITY_ACTION, retries=0)
     except Exception as e:
         logger.error(f"Error sending chat action: {e}")
 
+# ── Chat actions: fire-and-forget, deduplicated per chat ──────────────────────
+class ChatActions:
+    """
+    Sends chat actions in the background so they never delay a reply, and
+    skips an action if the same one went to the same chat within `window`
+    seconds. `keep()` re-sends the action while a long generation runs.
+    """
+
+    MAX_TRACKED = 10000
+
+    def __init__(self, window):
+        self.window = window
+        self.last_sent = {}   # (chat_id, action) → monotonic time
+        self.tasks = set()
+
+    def send(self, chat_id, action="typing"):
+        key = (chat_id, action)
+        now = time.monotonic()
+        if now - self.last_sent.get(key, float("-inf")) < self.window:
+            return None
+        if len(self.last_sent) >= self.MAX_TRACKED:
+            self.last_sent = {k: t for k, t in self.last_sent.items() if now - t < self.window}
+        self.last_sent[key] = now
+        task = asyncio.create_task(send_chat_action(chat_id, action))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    @contextlib.asynccontextmanager
+    async def keep(self, chat_id, action="typing"):
+        first = self.send(chat_id, action)
+        refresher = asyncio.create_task(self._refresh(chat_id, action))
+        try:
+            yield
+        finally:
+            refresher.cancel()
+            # An action that lands after the reply would show a stale “typing…”
+            if first is not None and not first.done():
+                first.cancel()
+
+    async def _refresh(self, chat_id, action):
+        while True:
+            await asyncio.sleep(self.window)
+            self.send(chat_id, action)
+
+chat_actions = ChatActions(CHAT_ACTION_WINDOW)
+
 # ── Utility: send a sticker (with optional reply_to_message_id) ───────────────
-def send_sticker(chat_id, sticker_file_id, reply_to_message_id=None):
+async def send_sticker(chat_id, sticker_file_id, reply_to_message_id=None):
     """
     Send a sticker to `chat_id`. If `reply_to_message_id` is set,
     Sakura will reply to that specific message with the sticker.
     """
     try:
-        url = f"{TELEGRAM_API_URL}/sendSticker"
         data = {
             "chat_id": chat_id,
             "sticker": sticker_file_id
         }
         if reply_to_message_id:
             data["reply_to_message_id"] = reply_to_message_id
-        response = requests.post(url, json=data)
-        return response.json()
+        with STAGE_SECONDS.time(stage="send"):
+            response = await app.sender.send("sendSticker", data, priority=PRIORITY_STICKER)
+        if not response:
+            logger.error(f"Error sending sticker: {response.description}")
+        return response
     except Exception as e:
         logger.error(f"Error sending sticker: {e}")
         return None
 
-# ── Utility: send a random Sakura sticker ──────────────────────────────────────
-def send_random_sakura_sticker(chat_id, reply_to_message_id=None):
+# ── Sticker pool: validated, weighted and non-repeating per chat ──────────────
+def emoji_key(emoji):
+    # Telegram reports some emoji with the variation selector and some without
+    return emoji.replace("\ufe0f", "") if emoji else ""
+
+def is_dead_file(response):
     """
-    Chooses one sticker_file_id at random from sakura_stickers,
-    shows “choosing a sticker” action, then sends it.
+    True if Telegram rejected a file_id itself (as opposed to e.g. a
+    missing reply target), so retrying it can never succeed.
     """
-    if not sakura_stickers:
-        return
+    return (response is not None and response.error_code == 400
+            and "file" in response.description.lower())
+
+class StickerPool:
+    """
+    Sticker file_ids with a weight and an optional emoji. `pick()` prefers
+    stickers whose emoji matches the sticker being answered and avoids the
+    last `no_repeat` stickers sent to the same chat. `validate()` expands
+    configured packs through getStickerSet, checks loose file_ids with
+    getFile and drops the dead ones; the checked pool is cached in the
+    state store so restarts skip the round trips until it goes stale.
+    """
+
+    MAX_TRACKED = 10000
+    CHECK_CONCURRENCY = 8
+
+    def __init__(self, stickers, packs=(), no_repeat=STICKER_NO_REPEAT):
+        self.stickers = [self._entry(s) for s in stickers]
+        self.packs = [p if isinstance(p, dict) else {"name": p} for p in packs]
+        self.no_repeat = no_repeat
+        self.digest = hashlib.sha256(
+            json.dumps([self.stickers, self.packs], sort_keys=True).encode()
+        ).hexdigest()
+        self.recent = OrderedDict()   # chat_id → deque of recently sent file_ids
+        self.checked = 0.0            # wall time of the last complete validation
+        self._load(self.stickers)
+
+    @staticmethod
+    def _entry(sticker, weight=1.0, emoji=""):
+        if isinstance(sticker, str):
+            return {"file_id": sticker, "weight": weight, "emoji": emoji}
+        return {
+            "file_id": sticker["file_id"],
+            "weight": float(sticker.get("weight", weight)),
+            "emoji": sticker.get("emoji", emoji)
+        }
+
+    @classmethod
+    def from_config(cls, path):
+        """
+        Build from the JSON file at `path` ("packs": sticker set names or
+        {"name", "weight"} objects, "stickers": file_ids or {"file_id",
+        "weight", "emoji"} objects), falling back to sakura_stickers.
+        """
+        config = {}
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    config = json.load(f)
+            except Exception as e:
+                logger.error(f"Could not load stickers from {path}: {e}")
+        return cls(config.get("stickers", [] if config.get("packs") else sakura_stickers),
+                   config.get("packs", ()))
+
+    def _load(self, entries):
+        self.weights = {}
+        self.by_emoji = {}
+        for entry in entries:
+            if entry["weight"] <= 0 or entry["file_id"] in self.weights:
+                continue
+            self.weights[entry["file_id"]] = entry["weight"]
+            if entry["emoji"]:
+                self.by_emoji.setdefault(emoji_key(entry["emoji"]), []).append(entry["file_id"])
+        self.file_ids = list(self.weights)
+        self.entries = entries
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def pick(self, chat_id, emoji=None):
+        """
+        Weighted choice for `chat_id`, or None if the pool is empty.
+        """
+        if not self.file_ids:
+            return None
+        recent = self.recent.get(chat_id, ())
+        matching = self.by_emoji.get(emoji_key(emoji)) if emoji else None
+        for candidates in (matching, self.file_ids):
+            fresh = [f for f in candidates or () if f not in recent]
+            if fresh:
+                break
+        else:
+            fresh = self.file_ids
+        choice = random.choices(fresh, weights=[self.weights[f] for f in fresh])[0]
+
+        keep = min(self.no_repeat, len(self.file_ids) - 1)
+        if keep > 0:
+            if chat_id not in self.recent:
+                if len(self.recent) >= self.MAX_TRACKED:
+                    self.recent.popitem(last=False)
+                self.recent[chat_id] = deque(maxlen=keep)
+            self.recent.move_to_end(chat_id)
+            self.recent[chat_id].append(choice)
+        return choice
+
+    def discard(self, file_id):
+        if file_id in self.weights:
+            self._load([e for e in self.entries if e["file_id"] != file_id])
+
+    def save(self, state):
+        state.set_state("stickers", json.dumps({
+            "digest": self.digest, "checked": self.checked, "stickers": self.entries
+        }))
+
+    async def validate(self, client, state, max_age=STICKER_CHECK_INTERVAL):
+        """
+        Load the cached check if it matches the current config and is
+        younger than `max_age`, otherwise check every pack and file_id
+        against Telegram. Ids that fail with a transport error are kept, as
+        are a pack's previously known stickers when getStickerSet fails the
+        same way, and the result isn't cached, so the next start checks again.
+        """
+        try:
+            cached = json.loads(state.get_state("stickers") or "{}")
+        except ValueError:
+            cached = {}
+        if cached.get("digest") == self.digest and time.time() - cached.get("checked", 0) < max_age:
+            self.checked = cached["checked"]
+            self._load(cached["stickers"])
+            logger.info(f"Using {len(self)} cached sticker(s)")
+            return
 
-    # 1) Show “Sakura is choosing a sticker…” indicator
-    send_chat_action(chat_id, action="choose_sticker")
+        complete = True
+        live = []
+        for pack in self.packs:
+            response = await client.call("getStickerSet", {"name": pack["name"]})
+            if response:
+                weight = float(pack.get("weight", 1.0))
+                live.extend(dict(self._entry(s["file_id"], weight, s.get("emoji", "")), pack=pack["name"])
+                            for s in response.result.get("stickers", []))
+            elif response.error_code is None:
+                complete = False
+                known = {}
+                for entry in self.entries + cached.get("stickers", []):
+                    if entry.get("pack") == pack["name"]:
+                        known.setdefault(entry["file_id"], entry)
+                logger.warning(f"Could not fetch sticker pack {pack['name']}: "
+                               f"keeping {len(known)} known sticker(s)")
+                live.extend(known.values())
+            else:
+                logger.error(f"Sticker pack {pack['name']} unavailable: {response.description}")
+
+        semaphore = asyncio.Semaphore(self.CHECK_CONCURRENCY)
+
+        async def check(entry):
+            async with semaphore:
+                return entry, await client.call("getFile", {"file_id": entry["file_id"]})
+
+        for entry, response in await asyncio.gather(*(check(e) for e in self.stickers)):
+            if not is_dead_file(response):
+                complete = complete and response.ok
+                live.append(entry)
+            else:
+                STICKERS_DROPPED.inc(stage="validate")
+                logger.warning(f"Dropping dead sticker {entry['file_id'][:24]}…: {response.description}")
+
+        self.checked = time.time()
+        self._load(live)
+        logger.info(f"Sticker pool ready: {len(self)} sticker(s)")
+        if complete:
+            self.save(state)
 
-    # 2) Pick random sticker and send
-    sticker_id = random.choice(sakura_stickers)
-    send_sticker(chat_id, sticker_id, reply_to_message_id=reply_to_message_id)
+# ── Utility: send a random Sakura sticker ──────────────────────────────────────
+async def send_random_sakura_sticker(chat_id, reply_to_message_id=None, emoji=None):
+    """
+    Sends a sticker from app.stickers, matched to `emoji` (the sticker being
+    answered) when the pool has one. A file_id Telegram rejects is dropped
+    from the pool and another sticker is tried once.
+    """
+    for _ in range(2):
+        sticker_id = app.stickers.pick(chat_id, emoji)
+        if sticker_id is None:
+            return None
+        response = await send_sticker(chat_id, sticker_id, reply_to_message_id=reply_to_message_id)
+        if not is_dead_file(response):
+            return response
+        STICKERS_DROPPED.inc(stage="send")
+        app.stickers.discard(sticker_id)
+        app.stickers.save(app.journal)
+    return response
 
 # ── Poll Telegram for new updates ────────────────────────────────────────────────
-def get_updates():
-    global last_update_id
+async def get_updates():
     try:
-        url = f"{TELEGRAM_API_URL}/getUpdates"
         params = {
-            "offset": last_update_id + 1,
-            "timeout": 30
+            "offset": app.journal.offset + 1,
+            "timeout": POLL_TIMEOUT,
+            "allowed_updates": ["message"]
         }
-        response = requests.get(url, params=params)
-        return response.json()
+        response = await app.telegram.call("getUpdates", params)
+        if not response:
+            logger.error(f"Error getting updates: {response.description}")
+        return response
     except Exception as e:
         logger.error(f"Error getting updates: {e}")
         return None
 
 # ── Register /start and /help commands so Telegram shows them in UI ──────────────
-def set_my_commands():
-    commands = [
-        {"command": "start", "description": "Start the bot"},
-        {"command": "help", "description": "How to use Sakura bot"}
-    ]
-    url = f"{TELEGRAM_API_URL}/setMyCommands"
-    response = requests.post(url, json={"commands": commands})
-    if response.status_code == 200:
+BOT_COMMANDS = [
+    {"command": "start", "description": "Start the bot"},
+    {"command": "help", "description": "How to use Sakura bot"}
+]
+
+async def set_my_commands():
+    """
+    Call setMyCommands only if BOT_COMMANDS changed since the last successful
+    registration (tracked by hash in the state store). Meant to run in the
+    background so it never delays the first poll.
+    """
+    digest = hashlib.sha256(json.dumps(BOT_COMMANDS, sort_keys=True).encode()).hexdigest()
+    if app.journal.get_state("commands_hash") == digest:
+        logger.info("Bot commands unchanged, skipping setMyCommands")
+        return
+    result = await app.telegram.call("setMyCommands", {"commands": BOT_COMMANDS})
+    if result:
+        app.journal.set_state("commands_hash", digest)
         logger.info("Bot commands set successfully")
     else:
-        logger.error("Failed to set bot commands")
+        logger.error(f"Failed to set bot commands: {result.description}")
 
 # ── Handle /start ───────────────────────────────────────────────────────────────
-def handle_start_command(chat_id, user_id):
+async def handle_start_command(chat_id, user_id):
     welcome_message = """
 <b>Hey there… I’m Sakura Haruno!</b> Your gentle guide and safe place 🌸
   
@@ -395,15 +1139,15 @@ You’re stronger than you feel. Brighter than you know. And I believe in you al
                 {"text": "Support", "url": "https://t.me/TheCryptoElders"}
             ],
             [
-                {"text": "Add Me to Your Group", "url": f"https://t.me/SluttySakuraBot?startgroup=true"}
+                {"text": "Add Me to Your Group", "url": f"https://t.me/{BOT_USERNAME}?startgroup=true"}
             ]
         ]
     }
-    send_message(chat_id, welcome_message, reply_markup=json.dumps(inline_keyboard))
+    await send_message(chat_id, welcome_message, reply_markup=json.dumps(inline_keyboard))
     logger.info(f"Sent /start to user {user_id}")
 
 # ── Handle /help ────────────────────────────────────────────────────────────────
-def handle_help_command(chat_id, user_id):
+async def handle_help_command(chat_id, user_id):
     help_text = """
 Hey… I’m Sakura 🌸  
 I’m here as your caring partner and gentle support  
@@ -419,36 +1163,962 @@ But I’ll reply in English or Bangla if that’s how you talk to me
 
 You can count on me for comfort encouragement or just quiet company 🤎  
 """
-    send_message(chat_id, help_text)
+    await send_message(chat_id, help_text)
     logger.info(f"Sent /help to user {user_id}")
 
-# ── Handle a normal text message (injecting the user's first name) ─────────────
-def handle_text_message(chat_id, user_id, first_name, text, reply_to_message_id=None):
-    try:
-        # Show “typing…” indicator before generating reply
-        send_chat_action(chat_id, action="typing")
+# ── Conversation history window ────────────────────────────────────────────────
+def estimate_tokens(text):
+    """
+    Cheap token estimate (~4 characters per token) so trimming never needs
+    a count_tokens round trip.
+    """
+    return len(text) // 4 + 1
+
+def history_tokens(history):
+    return sum(estimate_tokens(part) for turn in history for part in turn["parts"])
+
+def trim_history(history):
+    """
+    Drop the oldest user+model pairs until `history` fits in
+    HISTORY_MAX_TURNS pairs and roughly HISTORY_MAX_TOKENS tokens.
+    """
+    excess = len(history) - 2 * HISTORY_MAX_TURNS
+    if excess > 0:
+        del history[:excess + excess % 2]
+    while len(history) > 2 and history_tokens(history) > HISTORY_MAX_TOKENS:
+        del history[:2]
+
+# ── Session store: bounded per-user histories with optional disk spill ─────────
+class SessionStore:
+    """
+    LRU store of per-user Gemini histories. Entries idle for longer than
+    `ttl` seconds, or that push the store past `max_users` / `memory_budget`
+    bytes, are evicted. When `db_path` is set, evicted histories are written
+    to SQLite and restored on the user's next message, and `flush()` saves
+    everything still in memory so a restart keeps conversations.
+
+    With `shared` set (several worker processes on one database), SQLite is
+    the source of truth: `get()` picks up a history another process wrote
+    since this one last saw it, and `put()` writes through, so a user who
+    talks in chats routed to different workers keeps one history.
+    """
+
+    def __init__(self, max_users, ttl, memory_budget, db_path=None, shared=False):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.memory_budget = memory_budget
+        self.shared = shared and bool(db_path)
+        self.entries = OrderedDict()   # user_id → [history, last_used, size]
+        self.stamps = {}               # user_id → `updated` of the row this process last saw
+        self.bytes = 0
+        self.evictions = 0
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "user_id INTEGER PRIMARY KEY, history TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, user_id):
+        return user_id in self.entries
+
+    @staticmethod
+    def _size(history):
+        # Rough in-memory footprint: text plus per-turn dict/list overhead
+        return sum(len(part) for turn in history for part in turn["parts"]) + 200 * len(history)
+
+    def get(self, user_id):
+        """
+        Return the user's history list, restoring it from disk or creating
+        an empty one if it is not in memory.
+        """
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            if self.shared:
+                self._refresh(user_id, entry[0])
+            self._remember(user_id, entry[0])
+            return entry[0]
+        history = self._load(user_id) or []
+        self._remember(user_id, history)
+        return history
+
+    def put(self, user_id, history):
+        """
+        Store `history` for `user_id` (or re-account it after it was changed
+        in place) and evict whatever no longer fits.
+        """
+        self._remember(user_id, history)
+        if self.shared and user_id in self.entries:
+            self._save(user_id, history)
+
+    def _remember(self, user_id, history):
+        size = self._size(history)
+        old = self.entries.pop(user_id, None)
+        if old is not None:
+            self.bytes -= old[2]
+        self.entries[user_id] = [history, time.monotonic(), size]
+        self.bytes += size
+        self._evict()
+
+    def _evict(self):
+        now = time.monotonic()
+        while self.entries:
+            user_id, (history, last_used, size) = next(iter(self.entries.items()))
+            over_limit = len(self.entries) > self.max_users or self.bytes > self.memory_budget
+            if not over_limit and now - last_used < self.ttl:
+                break
+            # Never evict the entry that was just touched
+            if len(self.entries) == 1 and now - last_used < self.ttl:
+                break
+            del self.entries[user_id]
+            self.bytes -= size
+            self.evictions += 1
+            SESSION_EVICTIONS.inc()
+            self._save(user_id, history)
+            self.stamps.pop(user_id, None)
+
+    def _load(self, user_id):
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute(
+                "SELECT history, updated FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if not row:
+                return None
+            self.stamps[user_id] = row[1]
+            return json.loads(row[0])
+        except Exception as e:
+            logger.error(f"Error restoring session for {user_id}: {e}")
+            return None
+
+    def _refresh(self, user_id, history):
+        # Replaced in place, so callers holding the list (the compactor) see it changed
+        try:
+            row = self.db.execute(
+                "SELECT history, updated FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row and row[1] != self.stamps.get(user_id):
+                history[:] = json.loads(row[0])
+                self.stamps[user_id] = row[1]
+        except Exception as e:
+            logger.error(f"Error refreshing session for {user_id}: {e}")
+
+    def _save(self, user_id, history, commit=True):
+        if self.db is None or not history:
+            return
+        try:
+            updated = time.time()
+            self.db.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, history, updated) VALUES (?, ?, ?)",
+                (user_id, json.dumps(history), updated)
+            )
+            if commit:
+                self.db.commit()
+            self.stamps[user_id] = updated
+        except Exception as e:
+            logger.error(f"Error spilling session for {user_id}: {e}")
+
+    def flush(self):
+        """
+        Write every in-memory history to disk (no-op without a database).
+        """
+        if self.db is None:
+            return
+        for user_id, (history, _, _) in self.entries.items():
+            self._save(user_id, history, commit=False)
+        self.db.commit()
 
-        # If this is the first time this user chats, create a new Gemini chat for them
-        if user_id not in user_chats:
-            user_chats[user_id] = model.start_chat(history=[])
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
-        chat = user_chats[user_id]
+# ── Token budget: Gemini tokens each user may spend per day ──────────────────
+def utc_day():
+    return time.strftime("%Y-%m-%d", time.gmtime())
 
-        # ── 1) Normalize the user’s incoming text ────────────────────────────
-        normalized = text.lower().strip()
+class TokenBudget:
+    """
+    Per-user Gemini token counters for the current UTC day, kept in memory
+    and added to a `usage` table in SQLite so they survive restarts and are
+    shared by worker processes. `exhausted()` is a dict lookup; a `limit` of
+    0 only counts. Usage is written in batches at most every FLUSH_INTERVAL
+    seconds (and on close) rather than with a commit per reply. Rows older
+    than KEEP_DAYS are pruned at day rollover.
+    """
 
-        # ── 2) Check for simple greetings ──────────────────────────────────
-        greeting_keywords = {"hi", "hello", "hey", "namaste", "konichiwa"}
-        is_greeting = normalized in greeting_keywords
+    KEEP_DAYS = 7
+    FLUSH_INTERVAL = 5.0
+
+    def __init__(self, limit, db_path=None):
+        self.limit = limit
+        self.day = utc_day()
+        self.used = {}      # user_id → tokens today (as last seen by this process)
+        self.unsaved = {}   # user_id → tokens added since the last flush
+        self.flushed = time.monotonic()
+        self.db = None
+        if db_path:
+            self.db = sqlite3.connect(db_path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "day TEXT NOT NULL, user_id INTEGER NOT NULL, tokens INTEGER NOT NULL, "
+                "PRIMARY KEY (day, user_id))"
+            )
+            self.db.commit()
+            self.used = dict(self.db.execute(
+                "SELECT user_id, tokens FROM usage WHERE day = ?", (self.day,)
+            ).fetchall())
+
+    def _roll(self):
+        day = utc_day()
+        if day == self.day:
+            return
+        self.flush()
+        self.day = day
+        self.used = {}
+        if self.db is not None:
+            cutoff = time.strftime("%Y-%m-%d", time.gmtime(time.time() - self.KEEP_DAYS * 86400))
+            self.db.execute("DELETE FROM usage WHERE day < ?", (cutoff,))
+            self.db.commit()
+
+    def add(self, user_id, tokens):
+        self._roll()
+        if tokens <= 0:
+            return
+        self.used[user_id] = self.used.get(user_id, 0) + tokens
+        if self.db is None:
+            return
+        self.unsaved[user_id] = self.unsaved.get(user_id, 0) + tokens
+        if time.monotonic() - self.flushed >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the usage counted since the last flush to the database in one
+        transaction and pick up what other workers charged to those users.
+        """
+        self.flushed = time.monotonic()
+        if self.db is None or not self.unsaved:
+            return
+        unsaved, self.unsaved = self.unsaved, {}
+        try:
+            self.db.executemany(
+                "INSERT INTO usage (day, user_id, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT (day, user_id) DO UPDATE SET tokens = tokens + excluded.tokens",
+                [(self.day, user_id, tokens) for user_id, tokens in unsaved.items()]
+            )
+            self.db.commit()
+            for user_id in unsaved:
+                self.used[user_id] = self.db.execute(
+                    "SELECT tokens FROM usage WHERE day = ? AND user_id = ?", (self.day, user_id)
+                ).fetchone()[0]
+        except Exception as e:
+            logger.error(f"Error recording token usage for {len(unsaved)} user(s): {e}")
+
+    def exhausted(self, user_id):
+        self._roll()
+        return self.limit > 0 and self.used.get(user_id, 0) >= self.limit
+
+    def report(self, user_id):
+        self._roll()
+        used = self.used.get(user_id, 0)
+        if self.db is not None:
+            # Include what other workers charged since this process last looked
+            self.flush()
+            row = self.db.execute(
+                "SELECT tokens FROM usage WHERE day = ? AND user_id = ?", (self.day, user_id)
+            ).fetchone()
+            used = row[0] if row else 0
+        return {
+            "day": self.day,
+            "user_id": user_id,
+            "used": used,
+            "limit": self.limit,
+            "remaining": max(0, self.limit - used) if self.limit else None
+        }
 
-        # ── 3) Check for “emotional” keywords ──────────────────────────────
-        # Add or remove words as you like—these are examples of strong emotions.
-        emotional_keywords = {
-            "sad", "lonely", "anxiety", "anxious", "depressed", 
-            "heartbroken", "upset", "failed", "tired", "hurt"
+    def top(self, limit=20):
+        """
+        Today's heaviest users, most tokens first.
+        """
+        self._roll()
+        if self.db is not None:
+            self.flush()
+            rows = self.db.execute(
+                "SELECT user_id, tokens FROM usage WHERE day = ? ORDER BY tokens DESC LIMIT ?",
+                (self.day, limit)
+            ).fetchall()
+        else:
+            rows = heapq.nlargest(limit, self.used.items(), key=lambda item: item[1])
+        return {
+            "day": self.day,
+            "limit": self.limit,
+            "users": [{"user_id": user_id, "used": used} for user_id, used in rows]
         }
-        # Split on whitespace and see if any emotional word appears
-        contains_emotion = any(word in normalized.split() for word in emotional_keywords)
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+# ── Gemini gate: cap concurrent generations and shed load ────────────────────
+class GeminiOverloaded(Exception):
+    pass
+
+class GeminiGate:
+    """
+    Lets at most `max_concurrent` Gemini calls run at once. Callers queue
+    for a slot, but if `max_queue` are already waiting, or the wait exceeds
+    `queue_timeout` seconds, GeminiOverloaded is raised so the caller can
+    answer with a canned reply instead of timing out.
+    """
+
+    def __init__(self, max_concurrent, max_queue, queue_timeout):
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.shed = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self.slots.locked() and self.waiting >= self.max_queue:
+            self.shed += 1
+            GEMINI_SHED.inc()
+            raise GeminiOverloaded("Gemini queue is full")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            GEMINI_SHED.inc()
+            raise GeminiOverloaded("Timed out waiting for a Gemini slot")
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+# ── Model router: per-class models, fallback and hedged requests ──────────────
+def model_routes():
+    """
+    Models to try, in order, for each request class.
+    """
+    def route(*names):
+        return list(dict.fromkeys(n for n in names if n))
+    return {
+        "chat": route(GEMINI_MODEL, *GEMINI_FALLBACK_MODELS),
+        "light": route(GEMINI_LIGHT_MODEL, GEMINI_MODEL, *GEMINI_FALLBACK_MODELS),
+        "summary": route(GEMINI_LIGHT_MODEL, GEMINI_MODEL),
+    }
+
+class TimedStream:
+    """
+    A streamed response whose chunks must each arrive within `timeout`
+    seconds, so a stalled stream raises asyncio.TimeoutError instead of
+    holding its Gemini slot forever. `head` holds the chunks the router
+    already read to confirm the stream produces text.
+    """
+
+    def __init__(self, response, chunks, head, timeout):
+        self.response = response
+        self.chunks = chunks
+        self.head = head
+        self.timeout = timeout
+
+    @property
+    def usage_metadata(self):
+        return getattr(self.response, "usage_metadata", None)
+
+    async def __aiter__(self):
+        for chunk in self.head:
+            yield chunk
+        while True:
+            try:
+                chunk = await asyncio.wait_for(self.chunks.__anext__(), self.timeout)
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+class ModelRouter:
+    """
+    Sends a generation to the first model of its request class's route and
+    moves down the route when a model raises or takes longer than `timeout`.
+    With `hedge_after` set, the next model is also started once the current
+    one has been pending that long, and whichever answers first wins (the
+    other is cancelled), so one slow backend can't set the tail latency.
+    Models are created by `factory(name)` on first use, which lets tests
+    and the offline harness plug in stub backends; PLAIN_CLASSES, whose
+    prompts carry their own instructions, get `factory(name, persona=False)`
+    models without Sakura's persona. A stream counts as
+    answered once its first text chunk arrives; later chunks get `timeout`
+    each (see TimedStream).
+    """
+
+    PLAIN_CLASSES = frozenset({"summary"})
+
+    def __init__(self, routes, factory, timeout=GEMINI_TIMEOUT, hedge_after=GEMINI_HEDGE_AFTER):
+        self.routes = routes
+        self.factory = factory
+        self.timeout = timeout
+        self.hedge_after = hedge_after
+        self.models = {}   # (name, persona) → model
+
+    def model(self, name, persona=True):
+        model = self.models.get((name, persona))
+        if model is None:
+            model = self.models[name, persona] = self.factory(name) if persona else self.factory(name, persona=False)
+        return model
+
+    def warm_up(self):
+        for request_class, route in self.routes.items():
+            for name in route:
+                self.model(name, request_class not in self.PLAIN_CLASSES)
+
+    def route(self, request_class):
+        return self.routes.get(request_class) or self.routes["chat"]
+
+    async def _open(self, name, contents, stream, persona):
+        response = await self.model(name, persona).generate_content_async(contents, stream=stream)
+        if not stream:
+            return response
+        # Read up to the first chunk with text, so a model that stalls before
+        # anything reaches the user still fails over to the next one
+        chunks = response.__aiter__()
+        head = []
+        while True:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                break
+            head.append(chunk)
+            try:
+                if chunk.text:
+                    break
+            except ValueError:   # chunk without text (e.g. safety metadata)
+                pass
+        return TimedStream(response, chunks, head, self.timeout)
+
+    async def _attempt(self, name, contents, stream, persona=True):
+        try:
+            response = await asyncio.wait_for(self._open(name, contents, stream, persona), self.timeout)
+        except asyncio.CancelledError:
+            MODEL_REQUESTS.inc(model=name, result="cancelled")
+            raise
+        except asyncio.TimeoutError:
+            MODEL_REQUESTS.inc(model=name, result="timeout")
+            raise
+        except Exception:
+            MODEL_REQUESTS.inc(model=name, result="error")
+            raise
+        MODEL_REQUESTS.inc(model=name, result="ok")
+        return response
+
+    async def generate(self, contents, request_class="chat", stream=False):
+        """
+        Return the first successful response along the route, or raise the
+        last model's error. Streams are not hedged: a stream can't be
+        abandoned once its first chunk has been shown to the user.
+        """
+        remaining = list(self.route(request_class))
+        persona = request_class not in self.PLAIN_CLASSES
+        pending = {}   # task → model name
+        error = None
+
+        def launch():
+            name = remaining.pop(0)
+            pending[asyncio.create_task(self._attempt(name, contents, stream, persona))] = name
+
+        launch()
+        try:
+            while pending:
+                can_hedge = self.hedge_after > 0 and not stream and remaining and len(pending) == 1
+                hedge = self.hedge_after if can_hedge else None
+                done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.info(f"{pending[next(iter(pending))]} slower than {hedge}s, hedging with {remaining[0]}")
+                    launch()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        error = e
+                        logger.warning(f"Gemini model {name} failed: {e!r}")
+                if not pending and remaining:
+                    launch()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+# ── History compaction: fold older turns into a summary in the background ────
+SUMMARY_PREFIX = "# Summary of our earlier conversation:\n"
+SUMMARY_ACK = "Yaad hai mujhe 🤗"
+
+COMPACT_PROMPT = (
+    "Summarize this chat between the user and Sakura in under 80 words. Keep what "
+    "matters for continuing it: the user's name, mood, plans, likes and anything "
+    "Sakura promised. Plain sentences, no emoji.\n\n"
+)
+
+class HistoryCompactor:
+    """
+    Once a history passes `threshold` estimated tokens (or reaches the turn
+    cap), everything but the last `keep_turns` pairs is summarized by Gemini
+    in a background task and replaced by one summary pair, so the reply path
+    never waits for it. At most one compaction runs per user; it is skipped
+    while users are queueing for Gemini, and its result is dropped if the
+    history was trimmed in the meantime.
+    """
+
+    def __init__(self, threshold, keep_turns):
+        self.threshold = threshold
+        self.keep_turns = keep_turns
+        self.tasks = {}   # user_id → running compaction
+
+    def schedule(self, user_id, history):
+        if self.threshold <= 0 or user_id in self.tasks:
+            return None
+        # Worth it only if at least two pairs (or a summary and a pair) get folded
+        if len(history) < 2 * (self.keep_turns + 2):
+            return None
+        if history_tokens(history) < self.threshold and len(history) < 2 * HISTORY_MAX_TURNS:
+            return None
+        task = asyncio.create_task(self._compact(user_id, history))
+        self.tasks[user_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(user_id, None))
+        return task
+
+    @staticmethod
+    def transcript(turns):
+        lines = []
+        for turn in turns:
+            speaker = "User" if turn["role"] == "user" else "Sakura"
+            lines.append(f"{speaker}: {' '.join(turn['parts'])}")
+        return "\n".join(lines)
+
+    async def _compact(self, user_id, history):
+        older = history[:len(history) - 2 * self.keep_turns]
+        if app.gemini_gate.waiting:
+            HISTORY_COMPACTIONS.inc(result="skipped")
+            return
+        try:
+            async with app.gemini_gate.slot():
+                with STAGE_SECONDS.time(stage="compact"):
+                    response = await app.router.generate([
+                        {"role": "user", "parts": [COMPACT_PROMPT + self.transcript(older)]}
+                    ], request_class="summary")
+            record_gemini_usage(response, user_id)
+            summary = response.text.strip()
+        except GeminiOverloaded:
+            HISTORY_COMPACTIONS.inc(result="skipped")
+            return
+        except Exception as e:
+            HISTORY_COMPACTIONS.inc(result="failed")
+            logger.error(f"Error compacting history for {user_id}: {e}")
+            return
+
+        # trim_history may have dropped some of these turns while we waited
+        if not summary or len(history) < len(older) or any(a is not b for a, b in zip(history, older)):
+            HISTORY_COMPACTIONS.inc(result="stale")
+            return
+        history[:len(older)] = [
+            {"role": "user", "parts": [SUMMARY_PREFIX + summary]},
+            {"role": "model", "parts": [SUMMARY_ACK]}
+        ]
+        if user_id in app.user_chats:
+            app.user_chats.put(user_id, history)
+        HISTORY_COMPACTIONS.inc(result="done")
+        logger.info(f"Compacted history of {user_id}: {len(older)} turns → summary")
+
+# ── Response cache for greetings and short repeated prompts ───────────────────
+NAME_SLOT = "\x00name\x00"
+
+# Word characters plus combining marks and the Indic blocks, whose vowel signs
+# and viramas are not \w on their own
+_WORD_RE = re.compile(r"[\w\u0300-\u036f\u0900-\u0dff]+")
+
+# For ASCII text: lowercase word characters, every other byte becomes a space
+_ASCII_WORDS = bytes(
+    c if chr(c).isalnum() or c == ord("_") else ord(" ") for c in range(128)
+).lower() + bytes(128)
+
+def text_words(text):
+    """
+    The casefolded words of `text` (`_WORD_RE` matches); ASCII text takes a
+    byte-table fast path that gives the same words.
+    """
+    if text.isascii():
+        return text.encode().translate(_ASCII_WORDS).decode().split()
+    return _WORD_RE.findall(text.casefold())
+
+def normalize_text(text):
+    """
+    Casefold and reduce `text` to its words separated by single spaces, so
+    punctuation, symbols and emoji drop out while Devanagari and Bengali
+    words stay intact.
+    """
+    return " ".join(text_words(text))
+
+def detect_script(text):
+    """
+    Very small language hint from the writing system: "hi" for Devanagari,
+    "bn" for Bengali, "latin" for everything else (incl. Romanized Hindi).
+    """
+    for ch in text:
+        if "\u0900" <= ch <= "\u097f":
+            return "hi"
+        if "\u0980" <= ch <= "\u09ff":
+            return "bn"
+    return "latin"
+
+class ResponseCache:
+    """
+    LRU + TTL cache of Sakura replies keyed on (normalized text, script,
+    intent). Each key collects up to `variants` different generated replies
+    before it starts serving them, and never serves the same variant twice
+    in a row. The user's first name is stored as a slot and filled back in.
+    """
+
+    def __init__(self, max_keys, ttl, variants):
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.variants = variants
+        self.entries = OrderedDict()   # key → [replies, created, last_served]
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def key(text, intent):
+        return (normalize_text(text), detect_script(text), intent)
+
+    def get(self, key, first_name):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None or len(entry[0]) < self.variants:
+            self.misses += 1
+            RESPONSE_CACHE.inc(result="miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        RESPONSE_CACHE.inc(result="hit")
+        choices = [i for i in range(len(entry[0])) if i != entry[2]]
+        entry[2] = random.choice(choices) if choices else 0
+        reply = entry[0][entry[2]]
+        if first_name:
+            return reply.replace(NAME_SLOT, first_name)
+        # No name to fill in: drop the slot without leaving a double space
+        reply = " ".join(reply.replace(NAME_SLOT, " ").split())
+        return reply[:1].upper() + reply[1:]
+
+    def add(self, key, reply, first_name):
+        if first_name:
+            reply = re.sub(rf"\b{re.escape(first_name)}\b", NAME_SLOT, reply, flags=re.IGNORECASE)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = [[], time.monotonic(), None]
+            while len(self.entries) > self.max_keys:
+                self.entries.popitem(last=False)
+        if reply not in entry[0] and len(entry[0]) < self.variants:
+            entry[0].append(reply)
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS)
+
+# ── Message classifier: built once, shared by every update ────────────────────
+class MessageClassifier:
+    """
+    Prebuilt keyword matcher. Trigger words and the bot mention are plain
+    substring scans over the casefolded text (same semantics as `"sakura"
+    in text.lower()`), with ASCII text only checked against the ASCII
+    needles; greetings and emotions are token-set lookups on the words
+    `normalize_text` would keep, with multi-word emotion phrases matched on
+    word boundaries.
+    """
+
+    def __init__(self, triggers, greetings, emotions, bot_username):
+        needles = {t.casefold() for t in triggers if t}
+        if bot_username:
+            needles.add("@" + bot_username.casefold())
+        # A needle containing a shorter one ("@sluttysakurabot") never matches on its own
+        self.needles = tuple(sorted(n for n in needles if not any(o != n and o in n for o in needles)))
+        self.ascii_needles = tuple(n for n in self.needles if n.isascii())
+
+        self.greetings = frozenset(normalize_text(g) for g in greetings)
+        self.greeting_tokens = frozenset(t for g in self.greetings for t in g.split())
+        self.name_tokens = frozenset(normalize_text(t) for t in triggers)
+        self.greeting_or_name_tokens = self.greeting_tokens | self.name_tokens
+        emotions = [normalize_text(e) for e in emotions]
+        self.emotion_words = frozenset(e for e in emotions if " " not in e)
+        self.emotion_phrases = tuple(f" {e} " for e in emotions if " " in e)
+
+    @classmethod
+    def from_config(cls, path, bot_username):
+        """
+        Build from the default keyword lists, replacing any list that the
+        JSON file at `path` provides ("triggers", "greetings", "emotions").
+        """
+        overrides = {}
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    overrides = json.load(f)
+            except Exception as e:
+                logger.error(f"Could not load keywords from {path}: {e}")
+        return cls(
+            overrides.get("triggers", TRIGGER_WORDS),
+            overrides.get("greetings", GREETING_KEYWORDS),
+            overrides.get("emotions", EMOTIONAL_KEYWORDS),
+            bot_username
+        )
+
+    def is_triggered(self, text):
+        folded = text.casefold()
+        # Non-ASCII needles can't be in ASCII text, so that common case scans fewer
+        for needle in self.ascii_needles if folded.isascii() else self.needles:
+            if needle in folded:
+                return True
+        return False
+
+    def classify(self, text):
+        """
+        Return `(tokens, is_greeting, contains_emotion)`, where `tokens` are
+        the words of `normalize_text(text)`.
+        """
+        tokens = text_words(text)
+        token_set = set(tokens)
+        is_greeting = (not token_set.isdisjoint(self.greeting_tokens)
+                       and token_set <= self.greeting_or_name_tokens
+                       or " ".join(tokens) in self.greetings)
+        contains_emotion = not token_set.isdisjoint(self.emotion_words)
+        if not contains_emotion and self.emotion_phrases:
+            padded = f" {' '.join(tokens)} "
+            for phrase in self.emotion_phrases:
+                if phrase in padded:
+                    contains_emotion = True
+                    break
+        return tokens, is_greeting, contains_emotion
+
+# ── Ingest pre-filter: drop group chatter before any handler work ─────────────
+class UpdateFilter:
+    """
+    Cheap “could this be for Sakura?” check run at ingest, before an update
+    is journaled or dispatched. Private chats, /start and /help, replies to
+    the bot and texts containing one of the classifier's trigger needles (which
+    cover the @mention) pass; all other group chatter is dropped. `wants_raw()`
+    asks the same on the undecoded webhook body with byte searches and only
+    errs towards keeping, since `wants()` runs again after decoding.
+    """
+
+    COMMANDS = ("/start", "/help")
+    # Private chats, commands and escaped text (which can't be matched as bytes)
+    _RAW_ALWAYS = [rb'"type"\s*:\s*"private"', rb'"text"\s*:\s*"\s*/(?:start|help)', rb"\\u"]
+
+    def __init__(self, classifier, bot_username):
+        self.classifier = classifier
+        self.bot_username = bot_username.casefold()
+        needles = [n.encode() for n in classifier.needles] + [self.bot_username.encode()]
+        self.raw_re = re.compile(b"|".join(self._RAW_ALWAYS + [re.escape(n) for n in needles]))
+        self.checked = 0
+        self.dropped = 0
+
+    @property
+    def drop_ratio(self):
+        return self.dropped / self.checked if self.checked else 0.0
+
+    def _verdict(self, keep, stage):
+        self.checked += 1
+        if not keep:
+            self.dropped += 1
+        PREFILTER.inc(stage=stage, result="kept" if keep else "dropped")
+        return keep
+
+    def wants_raw(self, body):
+        if self.raw_re.search(body.lower()):
+            return True   # counted once decoded, by wants()
+        return self._verdict(False, "raw")
+
+    def wants(self, update):
+        message = update.get("message")
+        if not message:
+            return self._verdict(False, "decoded")
+        if message.get("chat", {}).get("type") == "private":
+            return self._verdict(True, "decoded")
+        text = message.get("text", "")
+        if text.lstrip().startswith(self.COMMANDS):
+            return self._verdict(True, "decoded")
+        reply_to = message.get("reply_to_message")
+        if reply_to and reply_to.get("from", {}).get("username", "").casefold() == self.bot_username:
+            return self._verdict(True, "decoded")
+        return self._verdict(self.classifier.is_triggered(text), "decoded")
+
+# ── Reply formatter: the persona's format rules, enforced locally ─────────────
+APPROVED_EMOJI = """
+😁 😆 🙃 🫠 😇 😘 😗 ☺️ 😚 😙 🥲 😛 😝 🤗 🤭 🫢 🤫 🤐 🤨
+😐 😑 😶 😬 😌 😔 😪 🤤 😴 🥵 😕 🫤 😟 🙁 ☹️ 😲 🥺 🥹 😥 😭 😢
+😩 😫 😤 💘 💝 💖 💗 💓 💞 💕 💟 ❣️ 💔 ❤️‍🔥 ❤️‍🩹 ❤️ 🧡 💛 💚 💙 💜
+🤎 🖤 🤍 💦 🫦 👀 🫶
+""".split()
+
+# Close relatives of the emoji Gemini likes to use, mapped onto the approved set
+EMOJI_SUBSTITUTES = {
+    "🙂": "🙃", "😊": "☺️", "😀": "😁", "😃": "😁", "😄": "😁", "😅": "🥲",
+    "😂": "😆", "🤣": "😆", "😉": "😗", "😍": "😘", "🥰": "💞", "😏": "😛",
+    "😜": "😝", "🤪": "😝", "😒": "😑", "🙄": "😑", "😞": "😔", "😓": "😥",
+    "😰": "😟", "😨": "😟", "😱": "😲", "😮": "😲", "😳": "😬", "🤔": "🤨",
+    "😠": "😤", "😡": "😤", "🥱": "😪", "💋": "😘", "♥️": "❤️", "✨": "💖",
+    "🌸": "💗", "👍": "🫶", "🙏": "🫶"
+}
+
+# When a reply has no usable emoji, one of these is picked by a hash of the text
+DEFAULT_EMOJI = ("🙃", "😇", "🤗", "🫶", "💞")
+
+# Words whose capital letter survives lowercasing (the user's name is added per reply)
+KEEP_CASE = frozenset({"I", "Im", "Ive", "Id", "Sakura", "Asad", "Naruto"})
+
+_APPROVED_BY_KEY = {emoji_key(e): e for e in APPROVED_EMOJI}
+_SUBSTITUTES_BY_KEY = {emoji_key(k): v for k, v in EMOJI_SUBSTITUTES.items()}
+
+# A pictograph with optional skin tone and variation selector, ZWJ sequences
+# as one match, plus stray selectors / joiners
+_PICTOGRAPH = "\U0001F000-\U0001FAFF\u2190-\u21FF\u2300-\u23FF\u2600-\u27BF\u2B00-\u2BFF\u2934\u2935\u3030\u303D"
+_EMOJI_RE = re.compile(
+    rf"[{_PICTOGRAPH}][\U0001F3FB-\U0001F3FF]?\ufe0f?(?:\u200d[{_PICTOGRAPH}][\U0001F3FB-\U0001F3FF]?\ufe0f?)*"
+    r"|[\ufe0f\u200d]"
+)
+_SKIN_TONE_RE = re.compile("[\U0001F3FB-\U0001F3FF]")
+_SPEAKER_RE = re.compile(r"^\s*sakura\s*:\s*", re.IGNORECASE)
+# Lookarounds come after the character so most positions fail on a cheap class test
+_APOSTROPHE_RE = re.compile(r"['’](?<=\w['’])(?=\w)")
+# Sentence punctuation; decimals, times and hyphenated words are left alone
+_TAG_RE = re.compile(r"</?[A-Za-z][^<>]*>")
+_PUNCT_RE = re.compile(r"[!?;…\"“”‘’'()\[\]{}*_`~#|¡¿«»।॥–—]|[.,:](?:(?!\d)|(?<!\d[.,:]))|-(?:(?!\w)|(?<!\w-))")
+
+def format_reply(text, first_name=""):
+    """
+    Enforce Sakura's format on generated text: the first non-empty line
+    only, no punctuation, only the first letter capitalized (KEEP_CASE and
+    the user's first name keep theirs), and exactly one approved emoji at
+    the end — the first approved (or substitutable) one the model used, or
+    a DEFAULT_EMOJI otherwise. Markup tags are dropped; the result is plain
+    text and is sent without parse_mode, so a stray < or & can't break it.
+    """
+    line = next((l for l in text.splitlines() if l.strip()), "")
+    line = _SPEAKER_RE.sub("", _TAG_RE.sub("", line))
+
+    emoji = None
+    for match in _EMOJI_RE.findall(line):
+        key = emoji_key(_SKIN_TONE_RE.sub("", match))
+        emoji = _APPROVED_BY_KEY.get(key) or _SUBSTITUTES_BY_KEY.get(key)
+        if emoji:
+            break
+    line = _PUNCT_RE.sub(" ", _APOSTROPHE_RE.sub("", _EMOJI_RE.sub(" ", line)))
+    if emoji is None:
+        emoji = DEFAULT_EMOJI[zlib.crc32(line.encode()) % len(DEFAULT_EMOJI)]
+
+    words = line.split()
+    if not words:
+        return emoji
+    keep = KEEP_CASE.union(first_name.split()) if first_name else KEEP_CASE
+    words = [w if w in keep else w.lower() for w in words]
+    words[0] = words[0][:1].upper() + words[0][1:]
+    return " ".join(words) + " " + emoji
+
+# ── Reply generation: whole reply or streamed with progressive edits ─────────
+def trim_reply(reply):
+    # Trim if it’s excessively long
+    if len(reply) > 4000:
+        reply = reply[:3900] + "... (message too long, sorry!) 🙃"
+    return reply
+
+async def stream_reply(chat_id, contents, reply_to_message_id=None, user_id=None,
+                       request_class="chat", first_name=""):
+    """
+    Generate with stream=True: the first chunk is sent as a new message,
+    formatted like the final reply, later chunks update it through editMessageText at most once every
+    STREAM_EDIT_INTERVAL seconds (skipping while an edit is still in
+    flight), and the formatted full text is written by a final edit. If the
+    stream stalls after that, the reply ends with the text received so far.
+    Returns the final reply text.
+    """
+    response = await app.router.generate(contents, request_class, stream=True)
+    text = ""
+    shown = ""
+    message_id = None
+    last_edit = 0.0
+    pending_edit = None
+
+    chunks = response.__aiter__()
+    while True:
+        try:
+            chunk = await chunks.__anext__()
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            # The reply has already started showing, so finish with what arrived
+            logger.warning(f"Gemini stream to {chat_id} stalled; ending the reply early")
+            break
+        try:
+            text += chunk.text
+        except ValueError:   # chunk without text (e.g. safety metadata)
+            continue
+        if not text.strip():
+            continue
+        # Partials get the same format as the final reply, so the text doesn't jump
+        partial = format_reply(text[:3900], first_name)
+        if message_id is None:
+            sent = await send_message(chat_id, partial, reply_to_message_id=reply_to_message_id, parse_mode=None)
+            if sent:
+                message_id = sent.result["message_id"]
+                shown = partial
+                last_edit = time.monotonic()
+        elif (time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL and partial != shown
+              and (pending_edit is None or pending_edit.done())):
+            pending_edit = asyncio.create_task(edit_message_text(
+                chat_id, message_id, partial, priority=PRIORITY_STICKER, retries=0, parse_mode=None
+            ))
+            shown = partial
+            last_edit = time.monotonic()
+
+    record_gemini_usage(response, user_id)
+    reply = format_reply(trim_reply(text), first_name)
+    if pending_edit is not None:
+        await pending_edit
+    if message_id is None:
+        await send_message(chat_id, reply, reply_to_message_id=reply_to_message_id, parse_mode=None)
+    elif reply != shown:
+        await edit_message_text(chat_id, message_id, reply, parse_mode=None)
+    return reply
+
+# ── Handle a normal text message (injecting the user's first name) ─────────────
+async def handle_text_message(chat_id, user_id, first_name, text, reply_to_message_id=None):
+    try:
+        # Fetch (or restore / start) this user's history
+        history = app.user_chats.get(user_id)
+
+        # ── 1-3) Normalize and classify (greeting? emotional?) in one pass ──
+        with STAGE_SECONDS.time(stage="classify"):
+            tokens, is_greeting, contains_emotion = app.classifier.classify(text)
 
         # ── 4) Build name_instruction only when greeting OR emotional ─────
         if is_greeting or contains_emotion:
@@ -460,33 +2130,71 @@ def handle_text_message(chat_id, user_id, first_name, text, reply_to_message_id=
         else:
             name_instruction = ""  # no forced name usage here
 
-        # ── 5) Assemble the final prompt to send to Gemini ─────────────────
-        enhanced_prompt = (
-            f"{SAKURA_PROMPT}\n\n"
-            f"{name_instruction}"
-            f"User: {text}\n\n"
-            f"Respond as Sakura Haruno:"
-        )
+        # ── 5) Assemble the user turn (persona lives in the system instruction)
+        user_turn = {"role": "user", "parts": [f"{name_instruction}{text}"]}
+
+        # ── 6) Greetings and short messages may be answered from cache, but only
+        # without history: a cached reply is served to other users, so it must
+        # not be generated from (or refer to) anyone's conversation
+        cache_key = None
+        if not history and (is_greeting or (not contains_emotion
+                                            and len(tokens) <= RESPONSE_CACHE_MAX_WORDS)):
+            cache_key = response_cache.key(text, "greeting" if is_greeting else "short")
+        reply = response_cache.get(cache_key, first_name) if cache_key else None
+
+        # Greetings and short chit-chat can go to the lighter model
+        request_class = "light" if cache_key and not contains_emotion else "chat"
+
+        already_sent = False
+        if reply is None and app.budget.exhausted(user_id):
+            BUDGET_EXHAUSTED.inc()
+            logger.info(f"Daily token budget used up by {first_name} ({user_id})")
+            await send_message(chat_id, random.choice(BUDGET_MESSAGES), reply_to_message_id=reply_to_message_id)
+            return
 
-        # ── 6) Send to Gemini and get Sakura’s reply ───────────────────────
-        response = chat.send_message(enhanced_prompt)
-        reply = response.text
+        if reply is None:
+            # ── 7) Send the bounded history to Gemini and get Sakura’s reply ───
+            # “typing…” goes out in the background and is refreshed until the reply is ready
+            async with app.gemini_gate.slot(), chat_actions.keep(chat_id, action="typing"):
+                with STAGE_SECONDS.time(stage="gemini"):
+                    if STREAM_REPLIES:
+                        reply = await stream_reply(
+                            chat_id, history + [user_turn], reply_to_message_id, user_id,
+                            request_class, first_name
+                        )
+                        already_sent = True
+                    else:
+                        response = await app.router.generate(history + [user_turn], request_class)
+                        record_gemini_usage(response, user_id)
+                        reply = format_reply(trim_reply(response.text), first_name)
+
+            if cache_key:
+                response_cache.add(cache_key, reply, first_name)
+        else:
+            logger.info(f"Cache hit for “{text[:20]}” (hit rate {response_cache.hit_rate:.0%})")
 
-        # Trim if it’s excessively long
-        if len(reply) > 4000:
-            reply = reply[:3900] + "... (message too long, sorry!) 🙃"
+        history.append(user_turn)
+        history.append({"role": "model", "parts": [reply]})
+        trim_history(history)
+        app.user_chats.put(user_id, history)
+        app.compactor.schedule(user_id, history)
 
-        # ── 7) Send Sakura’s reply back to Telegram ────────────────────────
-        send_message(chat_id, reply, reply_to_message_id=reply_to_message_id)
+        # ── 8) Send Sakura’s reply back to Telegram (streaming already did) ─
+        if not already_sent:
+            await send_message(chat_id, reply, reply_to_message_id=reply_to_message_id, parse_mode=None)
         logger.info(f"Sakura → [{first_name}]: {reply[:30]}…")
 
+    except GeminiOverloaded as e:
+        logger.warning(f"Shedding reply to {first_name} ({user_id}): {e}")
+        await send_message(chat_id, random.choice(BUSY_MESSAGES), reply_to_message_id=reply_to_message_id)
+
     except Exception as e:
         logger.error(f"Error in handle_text_message: {e}")
         error_msg = random.choice(ERROR_MESSAGES)
-        send_message(chat_id, error_msg)
+        await send_message(chat_id, error_msg)
 
 # ── Process each update from getUpdates ─────────────────────────────────────────
-def process_update(update):
+async def process_update(update):
     try:
         if "message" not in update:
             return
@@ -502,30 +2210,30 @@ def process_update(update):
 
         # ── 1) Always allow /start and /help ─────────────────────────────────
         if text.startswith("/start"):
-            handle_start_command(chat_id, user_id)
+            await handle_start_command(chat_id, user_id)
             return
         elif text.startswith("/help"):
-            handle_help_command(chat_id, user_id)
+            await handle_help_command(chat_id, user_id)
             return
 
         # ── 2) If this is a private chat, respond to every text ───────────────
         if chat_type == "private":
             logger.info(f"Private message from {first_name} ({user_id}): “{text}” → responding")
-            handle_text_message(chat_id, user_id, first_name, text)
+            await handle_text_message(chat_id, user_id, first_name, text)
             return
 
         # ── 2.5) If someone REPLIES to Sakura’s message with a STICKER ─────────
         if reply_to:
             from_field = reply_to.get("from", {})
-            # Replace "sluttysakurabot" with your actual bot username (no “@”)
-            if from_field.get("username", "").lower() == "sluttysakurabot":
+            if from_field.get("username", "").lower() == BOT_USERNAME.lower():
                 # Check if incoming message contains a sticker
                 if "sticker" in message:
                     logger.info(f"Detected user replied with a sticker to Sakura's message (chat: {chat_id}).")
-                    # Sakura chooses and sends a random sticker back
-                    send_random_sakura_sticker(
+                    # Sakura answers with a sticker, matching its emoji when she can
+                    await send_random_sakura_sticker(
                         chat_id,
-                        reply_to_message_id=message["message_id"]
+                        reply_to_message_id=message["message_id"],
+                        emoji=message["sticker"].get("emoji")
                     )
                     return
 
@@ -533,14 +2241,14 @@ def process_update(update):
         is_reply_to_bot = False
         if reply_to:
             from_field = reply_to.get("from", {})
-            if from_field.get("username", "").lower() == "sluttysakurabot":
+            if from_field.get("username", "").lower() == BOT_USERNAME.lower():
                 is_reply_to_bot = True
 
         if is_reply_to_bot:
             logger.info(
                 f"Detected reply to Sakura in group {chat_id} by {first_name} ({user_id}): “{text}”"
             )
-            handle_text_message(
+            await handle_text_message(
                 chat_id,
                 user_id,
                 first_name,
@@ -550,11 +2258,13 @@ def process_update(update):
             return
 
         # ── 4) In group chats, if someone types “Sakura”, respond ─────────────
-        if "sakura" in text.lower():
+        with STAGE_SECONDS.time(stage="classify"):
+            triggered = app.classifier.is_triggered(text)
+        if triggered:
             logger.info(
                 f"Detected keyword “Sakura” in group {chat_id} by {first_name} ({user_id}): “{text}”"
             )
-            handle_text_message(
+            await handle_text_message(
                 chat_id,
                 user_id,
                 first_name,
@@ -569,24 +2279,458 @@ def process_update(update):
     except Exception as e:
         logger.error(f"Error processing update: {e}")
 
-# ── Main loop: poll getUpdates, then process each update ──────────────────────
-async def main():
-    global last_update_id
+# ── Update journal: durable offset and crash-safe at-least-once handling ─────
+class UpdateJournal:
+    """
+    SQLite-backed record of where ingest stands. `accept()` writes new
+    updates to a `pending` table and advances the stored offset in one
+    transaction before they are dispatched; `done()` moves an update to
+    `processed` once its handler has finished. After a crash, `replay()`
+    returns whatever was accepted but never finished, and `processed`
+    doubles as an idempotency key so redelivered update_ids are ignored.
+    """
 
-    logger.info("🌸 Sakura Bot is starting up! 🌸")
-    logger.info("Make sure Privacy Mode is OFF so I see all messages in groups.")
-    set_my_commands()
+    PROCESSED_KEEP = 24 * 3600   # Telegram keeps unconfirmed updates for 24h
 
-    while True:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS pending (update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS processed (update_id INTEGER PRIMARY KEY, done REAL NOT NULL);"
+        )
+        self.db.commit()
+        self.offset = int(self.get_state("offset", "0"))
+        self.in_flight = set()
+        self._done_count = 0
+
+    def get_state(self, key, default=None):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, str(value)))
+        self.db.commit()
+
+    def _seen(self, update_id):
+        if update_id in self.in_flight:
+            return True
+        return self.db.execute(
+            "SELECT 1 FROM processed WHERE update_id = ? UNION ALL "
+            "SELECT 1 FROM pending WHERE update_id = ?", (update_id, update_id)
+        ).fetchone() is not None
+
+    def accept(self, updates, last_update_id=None):
+        """
+        Journal `updates` and return the ones that were not seen before.
+        `last_update_id` moves the offset past updates that were filtered
+        out at ingest and never journaled.
+        """
+        fresh = []
+        if last_update_id is not None:
+            self.offset = max(self.offset, last_update_id)
+        for update in updates:
+            update_id = update["update_id"]
+            self.offset = max(self.offset, update_id)
+            if self._seen(update_id):
+                continue
+            self.db.execute(
+                "INSERT INTO pending (update_id, payload) VALUES (?, ?)",
+                (update_id, json.dumps(update))
+            )
+            self.in_flight.add(update_id)
+            fresh.append(update)
+        self.db.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('offset', ?)", (str(self.offset),)
+        )
+        self.db.commit()
+        return fresh
+
+    def done(self, update_ids):
+        now = time.time()
+        for update_id in update_ids:
+            self.in_flight.discard(update_id)
+            self.db.execute("DELETE FROM pending WHERE update_id = ?", (update_id,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO processed (update_id, done) VALUES (?, ?)", (update_id, now)
+            )
+        self._done_count += len(update_ids)
+        if self._done_count >= 1000:
+            self._done_count = 0
+            self.db.execute("DELETE FROM processed WHERE done < ?", (now - self.PROCESSED_KEEP,))
+        self.db.commit()
+
+    def pending(self):
+        """
+        Updates accepted but not yet marked done, oldest first.
+        """
+        rows = self.db.execute("SELECT payload FROM pending ORDER BY update_id").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def replay(self):
+        """
+        Updates accepted by a previous run that never finished, oldest first.
+        """
+        updates = self.pending()
+        self.in_flight.update(u["update_id"] for u in updates)
+        return updates
+
+    def close(self):
+        self.db.close()
+
+# ── Dispatcher: one ordered queue per chat, chats run in parallel ──────────────
+def update_chat_id(update):
+    """
+    Return the chat_id an update belongs to, or None if it has no chat.
+    """
+    message = update.get("message")
+    if not message:
+        return None
+    return message.get("chat", {}).get("id")
+
+def is_mergeable(update):
+    """
+    Plain text messages (no command, no sticker) in group chats can be
+    merged with the same user's follow-up lines. Private chats are answered
+    right away, without waiting out the debounce window.
+    """
+    message = update.get("message")
+    if not message or "sticker" in message:
+        return False
+    if message.get("chat", {}).get("type") == "private":
+        return False
+    text = message.get("text", "")
+    return bool(text) and not text.startswith("/")
+
+def merge_updates(updates):
+    """
+    Combine consecutive text updates from one user into a single update: the
+    texts are joined line by line, the reply goes to the last message, and a
+    reply-to from any of them is kept so a reply to the bot still counts.
+    """
+    last = updates[-1]
+    message = dict(last["message"])
+    message["text"] = "\n".join(u["message"]["text"].strip() for u in updates)
+    reply_to = next((u["message"]["reply_to_message"] for u in updates
+                     if u["message"].get("reply_to_message")), None)
+    if reply_to:
+        message["reply_to_message"] = reply_to
+    return dict(last, message=message)
+
+class ChatDispatcher:
+    """
+    Shards updates by chat_id into per-chat queues. Each queue is drained by
+    its own worker task, so replies in one chat stay in order while different
+    chats never wait on each other. At most `max_concurrent` updates run at
+    once across all chats, and workers that stay idle for `idle_timeout`
+    seconds exit and are recreated on the chat's next update.
+
+    With a `debounce` window, a worker holding a group text message waits for
+    the same user's follow-up lines (up to `max_wait` seconds in total) and
+    hands them to the handler as one merged update.
+
+    `on_done`, if given, is called with the list of original updates once
+    the handler has finished with them.
+    """
+
+    def __init__(self, handler, max_concurrent, idle_timeout, debounce=0.0, max_wait=0.0,
+                 on_done=None):
+        self.handler = handler
+        self.on_done = on_done
+        self.idle_timeout = idle_timeout
+        self.debounce = debounce
+        self.max_wait = max_wait
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.queues = {}    # chat_id → asyncio.Queue
+        self.workers = {}   # chat_id → worker task
+
+    def submit(self, update):
+        chat_id = update_chat_id(update)
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue()
+            self.workers[chat_id] = asyncio.create_task(self._worker(chat_id, queue))
+        queue.put_nowait((time.monotonic(), update))
+
+    async def _coalesce(self, queue, update):
+        """
+        Pull the sender's follow-up messages off `queue` until the chat goes
+        quiet for `debounce` seconds. Returns the updates to merge and the
+        first non-matching queue item, if one had to be taken off the queue.
+        """
+        sender_id = update["message"].get("from", {}).get("id")
+        burst = [update]
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            wait = min(self.debounce, deadline - time.monotonic())
+            if wait <= 0:
+                return burst, None
+            try:
+                item = await asyncio.wait_for(queue.get(), wait)
+            except asyncio.TimeoutError:
+                return burst, None
+            follow_up = item[1]
+            if is_mergeable(follow_up) and follow_up["message"].get("from", {}).get("id") == sender_id:
+                burst.append(follow_up)
+            else:
+                return burst, item
+
+    async def _worker(self, chat_id, queue):
+        held = None
+        try:
+            while True:
+                if held is not None:
+                    (enqueued, update), held = held, None
+                else:
+                    try:
+                        enqueued, update = await asyncio.wait_for(queue.get(), self.idle_timeout)
+                    except asyncio.TimeoutError:
+                        if queue.empty():
+                            return
+                        continue
+
+                burst = [update]
+                if self.debounce > 0 and is_mergeable(update):
+                    burst, held = await self._coalesce(queue, update)
+                    if len(burst) > 1:
+                        update = merge_updates(burst)
+                try:
+                    async with self.slots:
+                        STAGE_SECONDS.observe(time.monotonic() - enqueued, stage="queue")
+                        await self.handler(update)
+                except Exception as e:
+                    logger.error(f"Error in chat worker {chat_id}: {e}")
+                finally:
+                    for _ in burst:
+                        queue.task_done()
+                # Not reached on cancellation: an interrupted update stays pending and is replayed
+                if self.on_done is not None:
+                    try:
+                        self.on_done(burst)
+                    except Exception as e:
+                        logger.error(f"Error acknowledging updates in chat {chat_id}: {e}")
+        finally:
+            # No await between the empty check and here, so nothing can slip in
+            self.queues.pop(chat_id, None)
+            self.workers.pop(chat_id, None)
+
+    def pending(self):
+        return sum(q.qsize() for q in self.queues.values())
+
+    async def drain(self, timeout):
+        """
+        Wait up to `timeout` seconds for every queued and running update to
+        finish, then stop the workers. Returns True if nothing was left over.
+        """
+        drained = True
         try:
-            result = get_updates()
-            if result and result.get("ok"):
-                updates = result.get("result", [])
-                for update in updates:
-                    last_update_id = update["update_id"]
-                    process_update(update)
+            await asyncio.wait_for(
+                asyncio.gather(*(q.join() for q in list(self.queues.values()))), timeout
+            )
+        except asyncio.TimeoutError:
+            drained = False
+        workers = list(self.workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return drained
+
+# ── Scale-out: one ingress process feeding N worker processes ─────────────────
+class WorkerPool:
+    """
+    Ingress side of multi-process mode. Updates are partitioned by chat_id
+    over `size` worker processes, each running its own ChatDispatcher, so a
+    chat always lands on the same worker (keeping its order and sessions)
+    while different chats use every core. Workers report handled update_ids
+    back on a shared queue, which is fed to `on_done`. A worker that dies is
+    restarted and gets its share of `pending()` again.
+
+    Exposes the same `submit()` as ChatDispatcher, so both ingest modes
+    work unchanged.
+    """
+
+    def __init__(self, size, on_done, pending):
+        # spawn, not fork: gRPC (used by Gemini) and aiohttp don't survive a fork
+        self.ctx = multiprocessing.get_context("spawn")
+        self.size = size
+        self.on_done = on_done
+        self.pending = pending
+        self.acks = self.ctx.Queue()
+        self.inboxes = [self.ctx.Queue() for _ in range(size)]
+        self.processes = [None] * size
+        self.tasks = []
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.size):
+            self._spawn(index)
+        self.tasks = [
+            asyncio.create_task(self._read_acks()),
+            asyncio.create_task(self._watch())
+        ]
 
-            await asyncio.sleep(1)
+    def _spawn(self, index):
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(index, self.inboxes[index], self.acks),
+            name=f"sakura-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def route(self, update):
+        return (update_chat_id(update) or 0) % self.size
+
+    def submit(self, update):
+        self.inboxes[self.route(update)].put(update)
+
+    async def _read_acks(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # Short timeout so the executor thread never outlives shutdown
+                update_ids = await loop.run_in_executor(None, self.acks.get, True, 0.5)
+            except Empty:
+                continue
+            try:
+                self.on_done([{"update_id": u} for u in update_ids])
+            except Exception as e:
+                logger.error(f"Error acknowledging updates from a worker: {e}")
+
+    async def _watch(self):
+        while not self.stopping:
+            await asyncio.sleep(5)
+            for index, process in enumerate(self.processes):
+                if self.stopping or process.is_alive():
+                    continue
+                logger.error(f"Worker {index} exited with code {process.exitcode}; restarting")
+                # Let an ack the reader thread already took land, then apply the
+                # rest, so nothing the dead worker finished is handled twice
+                await asyncio.sleep(1.0)
+                self._flush_acks()
+                if self.stopping:
+                    return
+                # No await from here on: everything for this partition that is not
+                # acked is in the journal, including what sits unread in the old
+                # inbox, so the new worker starts from a fresh inbox fed from there
+                self.inboxes[index] = self.ctx.Queue()
+                self._spawn(index)
+                for update in self.pending():
+                    if self.route(update) == index:
+                        self.submit(update)
+
+    def _flush_acks(self):
+        while True:
+            try:
+                update_ids = self.acks.get_nowait()
+            except Empty:
+                return
+            try:
+                self.on_done([{"update_id": u} for u in update_ids])
+            except Exception as e:
+                logger.error(f"Error acknowledging updates from a worker: {e}")
+
+    def reload(self):
+        """
+        Forward a config reload to every worker.
+        """
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    async def drain(self, timeout):
+        """
+        Ask every worker to finish its queue and exit, giving them `timeout`
+        seconds in total before they are terminated. Returns True if all of
+        them exited on their own.
+        """
+        self.stopping = True
+        for inbox in self.inboxes:
+            inbox.put(None)
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout
+        drained = True
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                drained = False
+                process.terminate()
+        for task in self.tasks:
+            task.cancel()
+        # Acks sent right before the workers exited, so they aren't replayed
+        self._flush_acks()
+        return drained
+
+def worker_main(index, inbox, acks):
+    """
+    Entry point of a worker process. Shutdown is driven by the ingress
+    process (a None on the inbox), so the worker ignores SIGINT / SIGTERM
+    and drains instead of dying with the rest of the process group.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    try:
+        asyncio.run(run_worker(index, inbox, acks))
+    except KeyboardInterrupt:
+        pass
+
+async def run_worker(index, inbox, acks):
+    logger.info(f"🌸 Worker {index} ready")
+    app.processes = WORKERS
+    background = [
+        asyncio.create_task(app.warm_up()),
+        asyncio.create_task(app.stickers.validate(app.telegram, app.journal))
+    ]
+    dispatcher = make_dispatcher(lambda updates: acks.put([u["update_id"] for u in updates]))
+    # The ingress process watches the config files and forwards SIGHUP
+    reloader = ConfigReloader(config_paths(), interval=0)
+    reloader.start()
+    loop = asyncio.get_running_loop()
+    metrics = await start_metrics_server(METRICS_PORT + 1 + index) if METRICS_PORT else None
+    try:
+        while True:
+            try:
+                update = await loop.run_in_executor(None, inbox.get, True, 0.5)
+            except Empty:
+                continue
+            if update is None:
+                break
+            dispatcher.submit(update)
+        if not await dispatcher.drain(SHUTDOWN_TIMEOUT):
+            logger.warning(f"Worker {index} stopped with updates unfinished; they will be replayed")
+    finally:
+        reloader.stop()
+        for task in background:
+            task.cancel()
+        if metrics is not None:
+            await metrics.cleanup()
+        await app.close()
+
+# ── Ingest mode 1: long polling with getUpdates ─────────────────────────────────
+async def run_polling(dispatcher):
+    while True:
+        try:
+            with STAGE_SECONDS.time(stage="poll"):
+                result = await get_updates()
+            if result:
+                # Group chatter nobody addressed to Sakura is never journaled or dispatched
+                wanted = [u for u in result.result if app.prefilter.wants(u)]
+                last_update_id = result.result[-1]["update_id"] if result.result else None
+                # Journal first, so a crash after this point replays instead of losing them
+                for update in app.journal.accept(wanted, last_update_id):
+                    UPDATES_RECEIVED.inc(source="poll")
+                    dispatcher.submit(update)
+            elif result is not None and result.error_code == 409:
+                # getUpdates is refused while a webhook is registered
+                logger.info("Webhook still registered, deleting it to switch to polling")
+                await app.telegram.call("deleteWebhook")
+            else:
+                # Don't spin on a failing endpoint
+                await asyncio.sleep(1)
 
         except KeyboardInterrupt:
             logger.info("Bot stopped by user")
@@ -595,5 +2739,352 @@ async def main():
             logger.error(f"Error in main loop: {e}")
             await asyncio.sleep(5)
 
+# ── Ingest mode 2: webhook served by a small built-in HTTP server ───────────────
+async def handle_webhook(request):
+    """
+    Accept one update from Telegram, verify the secret token header, and hand
+    the update to the dispatcher. Telegram only needs a fast 200 back.
+    """
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    # Compared as bytes: compare_digest raises TypeError on non-ASCII str
+    if not hmac.compare_digest(token.encode("utf-8", "surrogateescape"), WEBHOOK_SECRET.encode()):
+        logger.warning(f"Rejected webhook call from {request.remote}: bad secret token")
+        return web.Response(status=403)
+    # Most group traffic is rejected from the raw bytes, before JSON decoding
+    body = await request.read()
+    if not app.prefilter.wants_raw(body):
+        return web.Response(text="ok")
+    try:
+        update = json.loads(body)
+    except Exception:
+        return web.Response(status=400)
+    if not app.prefilter.wants(update):
+        return web.Response(text="ok")
+    # Telegram redelivers until it gets a 200; the journal drops duplicates
+    for update in app.journal.accept([update]):
+        UPDATES_RECEIVED.inc(source="webhook")
+        request.app["dispatcher"].submit(update)
+    return web.Response(text="ok")
+
+def make_webhook_app(dispatcher):
+    app = web.Application()
+    app["dispatcher"] = dispatcher
+    app.router.add_post(WEBHOOK_PATH, handle_webhook)
+    return app
+
+async def run_webhook(dispatcher):
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        logger.error("WEBHOOK_URL and WEBHOOK_SECRET must be set in webhook mode.")
+        return
+
+    runner = web.AppRunner(make_webhook_app(dispatcher))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        result = await app.telegram.call("setWebhook", {
+            "url": WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            "secret_token": WEBHOOK_SECRET,
+            "allowed_updates": ["message"]
+        })
+        if result:
+            logger.info("Webhook registered successfully")
+        else:
+            logger.error(f"Failed to register webhook: {result.description}")
+            return
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+# ── Application: clients and stores, each created on first use ────────────────
+class SakuraApp:
+    """
+    Owns everything that talks to the outside world or holds state. Every
+    attribute is built lazily on first access, so importing the module or
+    starting the bot does no network calls, and tests or tools can assign
+    their own stand-ins (e.g. `app.router = ModelRouter(model_routes(),
+    lambda name, persona=True: StubModel())`) before use.
+    """
+
+    def __init__(self, processes=1):
+        # Worker processes sharing the bot token; each gets 1/N of the send budget
+        self.processes = processes
+
+    @cached_property
+    def telegram(self):
+        return TelegramClient(TELEGRAM_API_URL)
+
+    @cached_property
+    def sender(self):
+        return SendScheduler(self.telegram, global_rate=GLOBAL_SEND_RATE / self.processes)
+
+    @cached_property
+    def gemini_gate(self):
+        return GeminiGate(GEMINI_MAX_CONCURRENT, GEMINI_MAX_QUEUE, GEMINI_QUEUE_TIMEOUT)
+
+    @cached_property
+    def persona(self):
+        if PERSONA_FILE:
+            try:
+                with open(PERSONA_FILE, encoding="utf-8") as f:
+                    return f.read()
+            except Exception as e:
+                logger.error(f"Could not load persona from {PERSONA_FILE}: {e}")
+        return SAKURA_PROMPT
+
+    def make_model(self, name, persona=True):
+        # The SDK (and gRPC) is slow to import, so only pay for it when needed
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        # The persona is sent once as a system instruction instead of on every turn;
+        # summaries go without it, since its one-line reply rule would squeeze them
+        return genai.GenerativeModel(name, system_instruction=self.persona if persona else None)
+
+    @cached_property
+    def router(self):
+        return ModelRouter(model_routes(), self.make_model)
+
+    @cached_property
+    def user_chats(self):
+        return SessionStore(
+            max_users=SESSION_MAX_USERS,
+            ttl=SESSION_TTL,
+            memory_budget=SESSION_MEMORY_BUDGET,
+            # Worker processes share histories through SQLite: chats are routed
+            # by chat_id, so one user's private and group chats can land apart
+            db_path=SESSION_DB_PATH or (STATE_DB_PATH if self.processes > 1 else None),
+            shared=self.processes > 1
+        )
+
+    @cached_property
+    def budget(self):
+        return TokenBudget(USER_DAILY_TOKENS, STATE_DB_PATH)
+
+    @cached_property
+    def compactor(self):
+        return HistoryCompactor(HISTORY_COMPACT_TOKENS, HISTORY_KEEP_TURNS)
+
+    @cached_property
+    def journal(self):
+        return UpdateJournal(STATE_DB_PATH)
+
+    @cached_property
+    def classifier(self):
+        return MessageClassifier.from_config(KEYWORDS_FILE, BOT_USERNAME)
+
+    @cached_property
+    def prefilter(self):
+        return UpdateFilter(self.classifier, BOT_USERNAME)
+
+    @cached_property
+    def stickers(self):
+        return StickerPool.from_config(STICKERS_FILE)
+
+    def reload(self):
+        """
+        Rebuild the persona, classifier (and pre-filter) and sticker pool
+        from their files. Sessions, the journal and open connections are
+        kept; a changed persona drops the built models and cached replies.
+        """
+        old_persona = self.__dict__.pop("persona", None)
+        if old_persona is not None and self.persona != old_persona:
+            if "router" in self.__dict__:
+                self.router.models.clear()
+            response_cache.entries.clear()
+        self.__dict__.pop("classifier", None)
+        self.__dict__.pop("prefilter", None)
+        old_stickers = self.__dict__.pop("stickers", None)
+        if old_stickers is not None:
+            self.stickers.recent = old_stickers.recent
+        logger.info("Reloaded persona, keywords and stickers")
+
+    async def warm_up(self):
+        """
+        Build the Gemini models in a thread so the first reply doesn't pay
+        for the SDK import.
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.router.warm_up)
+        except Exception as e:
+            logger.error(f"Error preparing Gemini model: {e}")
+
+    async def close(self):
+        if "telegram" in self.__dict__:
+            await self.telegram.close()
+        if "user_chats" in self.__dict__:
+            self.user_chats.close()
+        if "budget" in self.__dict__:
+            self.budget.close()
+        if "journal" in self.__dict__:
+            self.journal.close()
+
+app = SakuraApp()
+
+# ── Hot reload: persona, keywords and stickers without a restart ──────────────
+def config_paths():
+    return [p for p in (PERSONA_FILE, KEYWORDS_FILE, STICKERS_FILE) if p]
+
+class ConfigReloader:
+    """
+    Calls `app.reload()` on SIGHUP, and when any of `paths` changes on disk
+    if `interval` > 0 (checked by mtime every `interval` seconds). With
+    `stickers`, the new sticker pool is validated again (from the state
+    cache when its config didn't change); `on_reload` runs after each
+    reload, e.g. to pass it on to worker processes.
+    """
+
+    def __init__(self, paths, interval, stickers=True, on_reload=None):
+        self.paths = list(paths)
+        self.interval = interval
+        self.stickers = stickers
+        self.on_reload = on_reload
+        self.mtimes = self._mtimes()
+        self.tasks = set()
+
+    def _mtimes(self):
+        mtimes = {}
+        for path in self.paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def reload(self):
+        try:
+            app.reload()
+            if self.stickers:
+                self._spawn(app.stickers.validate(app.telegram, app.journal))
+            if self.on_reload is not None:
+                self.on_reload()
+        except Exception as e:
+            logger.error(f"Error reloading config: {e}")
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            mtimes = self._mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                logger.info("Config files changed on disk, reloading")
+                self.reload()
+
+    def start(self):
+        if hasattr(signal, "SIGHUP"):
+            with contextlib.suppress(NotImplementedError, RuntimeError):
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+        if self.interval > 0 and self.paths:
+            self._spawn(self.watch())
+
+    def stop(self):
+        if hasattr(signal, "SIGHUP"):
+            with contextlib.suppress(NotImplementedError, RuntimeError):
+                asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        for task in list(self.tasks):
+            task.cancel()
+
+# ── Dispatcher wiring shared by single-process mode and worker processes ─────
+def make_dispatcher(on_done):
+    dispatcher = ChatDispatcher(
+        process_update,
+        max_concurrent=MAX_CONCURRENT_UPDATES,
+        idle_timeout=CHAT_WORKER_IDLE_TIMEOUT,
+        debounce=DEBOUNCE_WINDOW,
+        max_wait=DEBOUNCE_MAX_WAIT,
+        on_done=on_done
+    )
+    QUEUE_DEPTH.set_function(dispatcher.pending, dispatcher="chat")
+    QUEUE_DEPTH.set_function(lambda: len(dispatcher.workers), dispatcher="chat_workers")
+    QUEUE_DEPTH.set_function(lambda: app.gemini_gate.waiting, dispatcher="gemini")
+    QUEUE_DEPTH.set_function(lambda: len(app.sender.global_limiter.waiters), dispatcher="send")
+    SESSIONS.set_function(lambda: len(app.user_chats), kind="users")
+    SESSIONS.set_function(lambda: app.user_chats.bytes, kind="bytes")
+    STICKER_POOL.set_function(lambda: len(app.stickers))
+    return dispatcher
+
+# ── Main: start the dispatcher (or worker pool) and the configured ingest mode ─
+async def main():
+    logger.info("🌸 Sakura Bot is starting up! 🌸")
+    logger.info("Make sure Privacy Mode is OFF so I see all messages in groups.")
+
+    if not TELEGRAM_TOKEN or not GEMINI_API_KEY:
+        logger.error("TELEGRAM_TOKEN and GEMINI_API_KEY must be set.")
+        raise SystemExit(1)
+
+    journal = app.journal
+    on_done = lambda updates: journal.done([u["update_id"] for u in updates])
+    if WORKERS > 1:
+        dispatcher = WorkerPool(WORKERS, on_done, journal.pending)
+        dispatcher.start()
+        for index in range(WORKERS):
+            # Looked up on every scrape: a restarted worker gets a new inbox
+            QUEUE_DEPTH.set_function(lambda i=index: dispatcher.inboxes[i].qsize(), dispatcher=f"worker_{index}")
+    else:
+        dispatcher = make_dispatcher(on_done)
+    PREFILTER_DROP_RATIO.set_function(lambda: app.prefilter.drop_ratio)
+    metrics = await start_metrics_server(METRICS_PORT) if METRICS_PORT else None
+
+    # Pick up whatever a previous run accepted but never finished
+    replayed = journal.replay()
+    if replayed:
+        logger.info(f"Replaying {len(replayed)} unfinished update(s) from the last run")
+    for update in replayed:
+        dispatcher.submit(update)
+
+    # Slow, non-essential setup runs alongside the first poll instead of before it
+    background = [asyncio.create_task(set_my_commands())]
+    if WORKERS <= 1:
+        background.append(asyncio.create_task(app.warm_up()))
+        background.append(asyncio.create_task(app.stickers.validate(app.telegram, app.journal)))
+
+    # Hot reload on SIGHUP (and on file changes); worker processes get it passed on
+    if WORKERS > 1:
+        reloader = ConfigReloader(config_paths(), CONFIG_WATCH_INTERVAL, stickers=False,
+                                  on_reload=dispatcher.reload)
+    else:
+        reloader = ConfigReloader(config_paths(), CONFIG_WATCH_INTERVAL)
+    reloader.start()
+
+    # SIGTERM (e.g. a dyno restart) and Ctrl-C stop ingest, then drain
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with contextlib.suppress(NotImplementedError, RuntimeError):
+            loop.add_signal_handler(sig, stop.set)
+
+    ingest = asyncio.create_task(
+        run_webhook(dispatcher) if UPDATE_MODE == "webhook" else run_polling(dispatcher)
+    )
+    stopping = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({ingest, stopping}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # 1) Stop taking updates; whatever Telegram sends meanwhile is redelivered later
+        ingest.cancel()
+        stopping.cancel()
+        await asyncio.gather(ingest, stopping, return_exceptions=True)
+        reloader.stop()
+
+        # 2) Let queued and in-flight replies finish
+        logger.info(f"Shutting down, finishing queued updates (up to {SHUTDOWN_TIMEOUT:.0f}s)")
+        if await dispatcher.drain(SHUTDOWN_TIMEOUT):
+            logger.info("All queued updates handled")
+        else:
+            logger.warning("Shutdown deadline reached; unfinished updates will be replayed on next start")
+
+        # 3) Persist sessions, journal and budgets, close connections
+        for task in background:
+            task.cancel()
+        if metrics is not None:
+            await metrics.cleanup()
+        await app.close()
+        logger.info("🌸 Sakura Bot stopped")
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())